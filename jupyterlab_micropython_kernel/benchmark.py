@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from . import deviceconnector
+from . import simdevice
+
+# times the DeviceConnector operations against simdevice over each transport, so that performance
+# work can be measured without hardware.
+#   python -m jupyterlab_micropython_kernel.benchmark --transport all --baud 115200
+
+
+def collect_output(output, asciigraphicscode=None, n04count=0, clear_output=False):
+    pass  # (the output is not wanted, only how long it takes)
+
+
+def connect(transport, device):
+    dc = deviceconnector.DeviceConnector(collect_output, collect_output)
+    if transport == "pty":
+        dc.serial_connect(simdevice.make_pty(device), 115200, False)
+    elif transport == "tcp":
+        dc.socket_connect("127.0.0.1", simdevice.make_tcp_server(device))
+    else:
+        dc.websocket_connect("ws://127.0.0.1:{}".format(simdevice.make_websocket_server(device)))
+        dc.read_device_until(b"Password: ")
+        dc.device_write(simdevice.simWebreplPassword.encode() + b"\r\n")
+        dc.read_device_until(b">>> ")
+    return dc
+
+
+def timed(fn, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def run_benchmarks(transport, baudrate, latency, repeat, file_size):
+    # returns [(name, value, unit)]
+    rootdir = tempfile.mkdtemp(prefix="simdevice")
+    for i in range(4):
+        os.makedirs(os.path.join(rootdir, "lib", "d{}".format(i)))
+        for j in range(10):
+            with open(os.path.join(rootdir, "lib", "d{}".format(i), "f{}.py".format(j)), "w") as fout:
+                fout.write("x = {}\n".format(j))
+    file_contents = os.urandom(file_size)
+    with open(os.path.join(rootdir, "data.bin"), "wb") as fout:
+        fout.write(file_contents)
+
+    device = simdevice.SimDevice(rootdir, baudrate, latency, start_raw=(transport == "tcp"))
+    device.start()
+    dc = connect(transport, device)
+    res = []
+    try:
+        if dc.working_socket is None:
+            # from the normal REPL, as after %serialconnect (the raw REPL does not answer the Ctrl-Cs)
+            res.append(("enter_paste_mode", timed(lambda: dc.enter_paste_mode(verbose=False), repeat,
+                                                  setup=lambda: dc.exit_paste_mode(False)) * 1000, "ms"))
+        else:
+            res.append(("enter_paste_mode", timed(lambda: dc.enter_paste_mode(verbose=False), repeat) * 1000, "ms"))
+        res.append(("cell round trip", timed(lambda: dc.run_cell("1"), repeat * 10) * 1000, "ms"))
+        res.append(("cell printing 1000 lines",
+                    timed(lambda: dc.run_cell("for i in range(1000):\n  print(i)"), repeat) * 1000, "ms"))
+        res.append(("listdir --recurse (44 entries)", timed(lambda: dc.listdir("", True), repeat) * 1000, "ms"))
+        res.append(("send_to_file", file_size / 1e3 / timed(
+            lambda: dc.send_to_file("up.bin", False, False, True, True, file_contents), repeat), "KB/s"))
+        res.append(("fetch_file", file_size / 1e3 / timed(
+            lambda: dc.fetch_file("data.bin", True, True), repeat), "KB/s"))
+        if dc.working_websocket is None:  # (which uses the WebREPL's file transfers instead)
+            res.append(("send_to_file_blocks", file_size / 1e3 / timed(
+                lambda: dc.send_to_file_blocks("new/sub/up.bin", True, False, True, file_contents), repeat), "KB/s"))
+            with open(os.path.join(rootdir, "new", "sub", "up.bin"), "rb") as fin:  # (--fast --mkdir, as first used)
+                if fin.read() != file_contents:
+                    raise RuntimeError("send_to_file_blocks wrote the wrong contents")
+            res.append(("fetch_file_blocks", file_size / 1e3 / timed(
+                lambda: dc.fetch_file_blocks("data.bin", True), repeat), "KB/s"))
+    finally:
+        dc.disconnect(raw=True)
+        shutil.rmtree(rootdir, ignore_errors=True)
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="jupyterlab_micropython_kernel.benchmark",
+                                 description="time the kernel's device operations against a simulated device")
+    ap.add_argument('--transport', choices=['pty', 'tcp', 'websocket', 'all'], default='all')
+    ap.add_argument('--baud', type=int, default=115200, help='simulated baudrate, 0 for unthrottled')
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds the device takes for each execution')
+    ap.add_argument('--repeat', type=int, default=3, help='times each operation is run (the median is kept)')
+    ap.add_argument('--filesize', type=int, default=16384, help='bytes in the file transfers')
+    ap.add_argument('--json', type=str, help='also save the results to this file')
+    args = ap.parse_args()
+
+    transports = ['pty', 'tcp', 'websocket'] if args.transport == 'all' else [args.transport]
+    if sys.platform == "win32" and 'pty' in transports:
+        transports.remove('pty')  # (no ptys)
+    results = {}
+    print("{:12}{:34}{:>12}".format("transport", "operation", "median"))
+    for transport in transports:
+        results[transport] = run_benchmarks(transport, args.baud, args.latency, args.repeat, args.filesize)
+        for name, value, unit in results[transport]:
+            print("{:12}{:34}{:>9.1f} {}".format(transport, name, value, unit))
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump({"baud": args.baud, "latency": args.latency, "results": results}, fout, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import serial
+
+# a separate process which keeps the serial port open (and the device in its raw REPL) across
+# kernel restarts.  Kernels attach with %brokerconnect over a local socket, one at a time, and
+# any others wait in the listen queue until the current one detaches.
+#   python -m jupyterlab_micropython_kernel.broker /dev/ttyUSB0 --baud 115200 --brokerport 9977
+
+brokerPortDefault = 9977
+brokerSavedOutputMax = 65536  # device output kept while no kernel is attached, passed on to the next
+brokerHello = b"BROKER ATTACH\r\n"  # first line from each kernel (sent before its turn comes)
+brokerGreeting = b"BROKER READY"  # first line sent to each kernel when its turn comes
+
+
+class DeviceBroker:
+    def __init__(self, portname, baudrate, brokerport):
+        self.portname = portname
+        self.baudrate = baudrate
+        self.working_serial = serial.Serial(portname, baudrate, timeout=0.5)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", brokerport))  # (local only)
+        self.server.listen(8)
+        self.client = None
+        self.saved_output = bytearray()
+        self.lock = threading.Lock()
+        self.running = True
+
+    def forward_device_output(self):
+        while self.running:
+            try:
+                b = self.working_serial.read(self.working_serial.in_waiting or 1)
+            except serial.SerialException as e:
+                sys.stderr.write("broker serial exception {}\n".format(e))
+                self.stop()
+                break
+            if b:
+                with self.lock:
+                    if self.client is not None:
+                        try:
+                            self.client.sendall(b)
+                        except OSError:
+                            pass  # the client is closing, it will be dropped by serve_client
+                    else:
+                        self.saved_output.extend(b)
+                        del self.saved_output[:-brokerSavedOutputMax]
+
+    def serve_client(self, client):
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client.settimeout(5)
+        try:
+            hello = client.recv(len(brokerHello), socket.MSG_WAITALL)
+        except OSError:
+            hello = b''
+        if hello != brokerHello:
+            client.close()  # (not a kernel)
+            return
+        client.settimeout(None)
+        with self.lock:
+            greeting = "{} {} {} {}\r\n".format(brokerGreeting.decode(), os.getpid(), self.portname, self.baudrate)
+            try:
+                client.sendall(greeting.encode() + bytes(self.saved_output))
+            except OSError:
+                client.close()
+                return
+            self.saved_output.clear()
+            self.client = client
+        try:
+            while self.running:
+                b = client.recv(4096)
+                if not b:
+                    break
+                self.working_serial.write(b)
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            with self.lock:
+                self.client = None
+            client.close()
+
+    def serve_forever(self):
+        threading.Thread(target=self.forward_device_output, daemon=True).start()
+        while self.running:
+            try:
+                client, addr = self.server.accept()
+            except OSError:
+                break
+            self.serve_client(client)  # one kernel at a time, the next waits in accept
+        self.working_serial.close()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            if self.client is not None:
+                try:
+                    self.client.shutdown(socket.SHUT_RDWR)  # (its kernel sees the connection broken)
+                except OSError:
+                    pass
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+
+
+def spawn_broker(portname, baudrate, brokerport):
+    # detached, so it outlives the kernel which started it
+    pargs = [sys.executable, "-m", "jupyterlab_micropython_kernel.broker", portname,
+             "--baud", str(baudrate), "--brokerport", str(brokerport)]
+    if sys.platform == "win32":
+        kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS}
+    else:
+        kwargs = {"start_new_session": True}
+    return subprocess.Popen(pargs, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            **kwargs)
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="jupyterlab_micropython_kernel.broker",
+                                 description="keeps a serial connection to a MicroPython device open for kernels")
+    ap.add_argument('port', type=str)
+    ap.add_argument('--baud', type=int, default=115200)
+    ap.add_argument('--brokerport', type=int, default=brokerPortDefault)
+    args = ap.parse_args()
+    broker = DeviceBroker(args.port, args.baud, args.brokerport)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
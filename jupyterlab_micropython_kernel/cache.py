@@ -0,0 +1,77 @@
+import hashlib
+import os
+
+# files the kernel keeps on disk across sessions (converted notebooks, compiled .mpy files, where
+# esptool is), under $XDG_CACHE_HOME/jupyterlab_micropython_kernel.  The caches are only an
+# optimization, so reading or writing them never raises; a missing entry is just made again.
+
+
+def default_cache_dir(name):
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "jupyterlab_micropython_kernel", name)
+
+
+def read_cached(path):
+    # the contents (bytes), or None
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # keeps recently used entries from being evicted
+        return data
+    except OSError:
+        return None
+
+
+def write_cached(path, data):
+    # written to a temporary file first, so another kernel never reads half of it; False if it could not be
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, path)
+        return True
+    except OSError:
+        return False
+
+
+def evict_least_recent(cache_dir, suffix, max_bytes):
+    # remove least recently used entries until within max_bytes
+    entries = []
+    try:
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(suffix):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+# entries keyed by the sha256 of the parts that make them what they are (a format version first, so
+# that entries made the old way are not reused), the least recently used evicted beyond max_bytes
+class DiskCache:
+    def __init__(self, cache_dir, suffix, max_bytes):
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+
+    def entry_file(self, key_parts):
+        return os.path.join(self.cache_dir, hashlib.sha256(b"\0".join(key_parts)).hexdigest() + self.suffix)
+
+    def get(self, key_parts):
+        return read_cached(self.entry_file(key_parts))
+
+    def put(self, key_parts, data):
+        return write_cached(self.entry_file(key_parts), data)
+
+    def evict(self):
+        evict_least_recent(self.cache_dir, self.suffix, self.max_bytes)
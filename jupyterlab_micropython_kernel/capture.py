@@ -0,0 +1,128 @@
+import gzip
+import os
+import time
+
+# backend of %capture, for output which can run to hundreds of MB
+captureBufferSize = 1024 * 1024
+captureJoinBytes = 65536
+captureColumnChunkRows = 65536  # rows of numbers saved together in each .npy file
+
+
+def numbered_filename(filename, n):
+    # data.csv -> data-0001.csv (and data.csv.gz -> data-0001.csv.gz)
+    dirname, basename = os.path.split(filename)
+    stem, dot, ext = basename.partition(".")
+    return os.path.join(dirname, "{}-{:04d}{}{}".format(stem, n, dot, ext))
+
+
+# writes the captured text through a large buffer (optionally gzipped and rotated by size),
+# and can also parse lines of delimited numbers into columns saved as .npy files
+class CaptureWriter:
+    def __init__(self, filename, compress=False, rotate_bytes=0, columns=False, delimiter=","):
+        self.numpy = None
+        if columns:
+            import numpy  # (optional dependency, only needed for --columns)
+            self.numpy = numpy
+        self.filename = filename + (".gz" if compress and not filename.endswith(".gz") else "")
+        self.compress = compress
+        self.rotate_bytes = rotate_bytes
+        self.delimiter = delimiter
+        self.line_count = 0
+        self.byte_count = 0
+        self.file_count = 0
+        self.filenames = []
+        self.start_time = time.time()
+        self.fout = None
+        self.file_bytes = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.open_next()
+
+        self.partial_line = ""
+        self.rows = []
+        self.column_count = None
+        self.column_file_count = 0
+        self.skipped_rows = 0
+
+    def open_next(self):
+        if self.fout is not None:
+            self.fout.close()
+        self.file_count += 1
+        filename = self.filename if not self.rotate_bytes else numbered_filename(self.filename, self.file_count)
+        if self.compress:
+            self.fout = gzip.open(filename, "wt", encoding="utf8", newline="", compresslevel=1)  # (fast rather than small)
+        else:
+            self.fout = open(filename, "w", encoding="utf8", newline="", buffering=captureBufferSize)
+        self.filenames.append(filename)
+        self.file_bytes = 0
+
+    def write(self, output):
+        # (fragments are joined up before writing, as the calls cost more than the bytes)
+        self.pending.append(output)
+        self.pending_bytes += len(output)
+        if self.pending_bytes >= captureJoinBytes:
+            self.write_pending()
+
+    def write_pending(self):
+        output = "".join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        newlines = output.count("\n")
+        if self.rotate_bytes and self.file_bytes + len(output) >= self.rotate_bytes and newlines:
+            i = output.rindex("\n") + 1  # the next file starts on a new line
+            self.fout.write(output[:i])
+            self.open_next()
+            self.fout.write(output[i:])
+            self.file_bytes += len(output) - i
+        else:
+            self.fout.write(output)
+            self.file_bytes += len(output)
+        self.byte_count += len(output)  # (counting characters, which is bytes for ascii)
+        self.line_count += newlines
+        if self.numpy is not None:
+            self.add_rows(output)
+
+    def lines_captured(self):
+        return self.line_count + "".join(self.pending).count("\n")
+
+    def add_rows(self, output):
+        lines = (self.partial_line + output).split("\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            try:
+                row = [float(x) for x in line.split(self.delimiter)]
+            except ValueError:
+                self.skipped_rows += 1  # headers and messages stay in the text file only
+                continue
+            if len(row) != self.column_count:
+                self.save_columns()
+                self.column_count = len(row)
+            self.rows.append(row)
+            if len(self.rows) >= captureColumnChunkRows:
+                self.save_columns()
+
+    def save_columns(self):
+        if self.rows:
+            self.column_file_count += 1
+            stem = self.filename[:-3] if self.filename.endswith(".gz") else self.filename
+            npyfilename = numbered_filename(os.path.splitext(stem)[0] + ".npy", self.column_file_count)
+            self.numpy.save(npyfilename, self.numpy.array(self.rows, dtype=self.numpy.float64))
+            self.filenames.append(npyfilename)
+            self.rows = []
+
+    def close(self):
+        self.write_pending()
+        if self.numpy is not None:
+            if self.partial_line:
+                self.add_rows("\n")
+            self.save_columns()
+        self.fout.close()
+
+    def stats(self):
+        seconds = max(time.time() - self.start_time, 1e-6)
+        res = "{} lines ({:.1f} MB) captured in {:.1f}s, {:.2f} MB/s, {} lines/s, into {} file{}".format(
+            self.line_count, self.byte_count / 1e6, seconds, self.byte_count / 1e6 / seconds,
+            int(self.line_count / seconds), len(self.filenames), ("" if len(self.filenames) == 1 else "s"))
+        if self.numpy is not None:
+            res += " ({} lines were not rows of numbers)".format(self.skipped_rows)
+        return res
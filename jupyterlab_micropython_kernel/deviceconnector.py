@@ -1,18 +1,190 @@
-import ast
 import binascii
+import collections
+import concurrent.futures
+import os
 import re
+import struct
 import subprocess
 import sys
+import threading
 import time
+import zlib
 
 import select
+import signal
 import serial
 import serial.tools.list_ports
 import socket
-import websocket  # the old non async one
+
+from . import broker
+from . import devicetree
+from . import flashing
+from . import recording
 
 serialTimeout = 0.5
 serialTimeoutCount = 10
+serialIdleTime = 0.05  # quiet after some output for which yield_serial_chunk yields None (so buffered output is sent)
+socketReadSize = 65536
+socketWriteBufferSize = 65536  # writes are gathered up to this and sent when an answer is waited for
+socketSendBufferSize = 262144  # SO_SNDBUF, so a file transfer's payload can be handed over without waiting
+readerBufferMax = 1024 * 1024  # oldest bytes are dropped beyond this when nothing is reading the device
+rawPasteBlockSize = 4096  # bytes of source sent per execution when streaming file contents in raw paste mode
+rawPasteChunkSize = 192  # bytes encoded into each O.write() statement in raw paste mode
+replPromptTimeout = 0.3  # first wait for the >>> prompt after the Ctrl-Cs, multiplied by replPromptBackoff each retry
+replPromptBackoff = 1.5
+replPromptMaxTimeout = 2.0
+replPromptRetries = 10
+rawReplBannerTimeout = 1.0
+brokerStartTimeout = 5.0
+brokerWaitTimeout = 10.0  # for another kernel to finish with the device broker
+blockTransferSize = 1024  # default bytes per block for %sendfile/%fetchfile --fast
+blockTransferWindow = 4  # default blocks sent between acknowledgements
+webreplRequest = struct.Struct("<2sBBQLH64s")  # WebREPL's own file transfer: b"WA", kind, 0, 0, size, len(name), name
+webreplPutFile = 1
+webreplGetFile = 2
+webreplBlockSize = 16384  # bytes in each binary frame of a put (the device reads them a bit at a time)
+webreplProbeTimeout = 2.0  # for the answer to the first transfer, before falling back to the REPL
+
+# device side of the --fast transfers, installed once per raw REPL session.  Blocks are framed as
+# 4 byte length, 4 byte crc32 (little endian) and data, and each window of blocks is answered with
+# A (all good) or E (resend the window).  The device writes R (or r when it has no crc32) once ready.
+# (These helpers, like the others installed once per session, import what they use inside themselves or
+# bind it as a default argument, so that a cell rebinding os or sys does not break them.)
+blockTransferHelpers = """try:
+  from binascii import crc32 as O_crc
+except ImportError:
+  O_crc = None
+def O_put(f,m,n,b,w,c=O_crc):
+  import sys,micropython
+  i=sys.stdin.buffer
+  o=open(f,m)
+  micropython.kbd_intr(-1)
+  try:
+    sys.stdout.write('R' if c else 'r')
+    while n>0:
+      d=[]
+      g=1
+      for j in range(min(w,(n+b-1)//b)):
+        h=i.read(8)
+        x=i.read(int.from_bytes(h[:4],'little'))
+        if c and c(x)!=int.from_bytes(h[4:],'little'):
+          g=0
+        d.append(x)
+      if g:
+        for x in d:
+          o.write(x)
+          n-=len(x)
+      sys.stdout.write('A' if g else 'E')
+      d=None
+  finally:
+    micropython.kbd_intr(3)
+    o.close()
+def O_get(f,b,w,c=O_crc):
+  import sys,os,micropython
+  i=sys.stdin.buffer
+  o=sys.stdout.buffer
+  n=os.stat(f)[6]
+  r=open(f,'rb')
+  micropython.kbd_intr(-1)
+  try:
+    o.write((b'R' if c else b'r')+n.to_bytes(4,'little'))
+    p=0
+    while p<n:
+      r.seek(p)
+      q=p
+      for j in range(min(w,(n-p+b-1)//b)):
+        x=r.read(b)
+        q+=len(x)
+        o.write(len(x).to_bytes(4,'little')+(c(x) if c else 0).to_bytes(4,'little'))
+        o.write(x)
+      if i.read(1)==b'A':
+        p=q
+  finally:
+    micropython.kbd_intr(3)
+    r.close()
+"""
+
+# device side of send_files, installed once per raw REPL session
+batchTransferHelpers = """try:
+  from binascii import a2b_base64 as O_b64
+except ImportError:
+  from ubinascii import a2b_base64 as O_b64
+def O_mkdirs(ds):
+  import os
+  for d in ds:
+    try:
+      os.mkdir(d)
+    except OSError:
+      pass
+"""
+
+# device side of send_files(compress=True), installed once per raw REPL session.  O_Z opens a
+# decompressing stream (deflate from MicroPython 1.21, zlib before that), or is None when the firmware has neither,
+# and O_unz decompresses the file s into p a block at a time
+compressWbits = 10  # window of 1 KB, which the smallest boards can allocate to decompress
+compressMinRatio = 0.9  # files are only sent compressed when that takes less than this of the bytes otherwise
+compressHelpers = """try:
+  from deflate import DeflateIO as O_DIO, ZLIB as O_ZLIB
+  def O_Z(f, D=O_DIO, z=O_ZLIB):
+    return D(f, z)
+except ImportError:
+  try:
+    from zlib import DecompIO as O_DIO
+    def O_Z(f, D=O_DIO):
+      return D(f, %d)
+  except ImportError:
+    O_Z = None
+def O_unz(s, p, Z=O_Z):
+  import os
+  f = open(s, 'rb')
+  o = open(p, 'wb')
+  d = Z(f)
+  b = bytearray(256)
+  m = memoryview(b)
+  n = d.readinto(b)
+  while n:
+    o.write(m[:n])
+    n = d.readinto(b)
+  o.close()
+  f.close()
+  os.remove(s)
+""" % compressWbits
+
+
+def batch_file_statements(destination_filename, file_contents, binary, chunk_size, compress):
+    # the statements writing one whole file in send_files, and whether they are compressed
+    def chunk_statements(b):
+        return [b'O.write(O_b64("' + binascii.b2a_base64(b[i:i + chunk_size])[:-1] + b'"))\r\n'
+                for i in range(0, len(b), chunk_size)]
+
+    if not binary:
+        lines = file_contents.splitlines(True)
+        if max(map(len, lines), default=0) > 250:
+            binary = True  # (the same file, in chunks)
+    if binary and type(file_contents) == str:
+        file_contents = file_contents.encode("utf8")
+    statements = ["O=open({}, '{}')\r\n".format(repr(destination_filename), ("wb" if binary else "w")).encode()]
+    if binary:
+        statements.extend(chunk_statements(file_contents))
+    else:
+        statements.extend("O.write({})\r\n".format(repr(line)).encode() for line in lines)
+    statements.append(b"O.close()\r\n")
+    if not compress:
+        return statements, False
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, compressWbits)
+    compressed = compressor.compress(file_contents if binary else file_contents.encode("utf8")) + compressor.flush()
+    temp_filename = destination_filename + ".z~"
+    compressed_statements = ["O=open({}, 'wb')\r\n".format(repr(temp_filename)).encode()]
+    compressed_statements.extend(chunk_statements(compressed))
+    compressed_statements.append("O.close(); O_unz({}, {})\r\n".format(repr(temp_filename),
+                                                                        repr(destination_filename)).encode())
+    if sum(map(len, compressed_statements)) < compressMinRatio * sum(map(len, statements)):
+        return compressed_statements, True
+    return statements, False
+
+
+serialChunkDelimiters = re.compile(b"OK|\x04|>|\r\n")
 
 wifiMessageIgnore = re.compile(
     "(\x1b\[[\d;]*m)?[WI] \(\d+\) (wifi|system_api|modsocket|phy|event|cpu_start|heap_init|network|wpa): ")
@@ -26,76 +198,200 @@ def guess_serial_port():
     return [x.device for x in lp]
 
 
+def read_serial_available(s):
+    # bulk read whatever has arrived on the connection, returns b'' after serialTimeout with nothing
+    if isinstance(s, serial.SerialBase):  # (includes the socket:// connection to a device broker)
+        return s.read(s.in_waiting or 1)
+
+    if type(s) in (socket.socket, socket.SocketIO):
+        sock = s._sock if type(s) == socket.SocketIO else s
+        r, w, e = select.select([sock], [], [], serialTimeout)
+        if not r:
+            return b''
+        res = sock.recv(socketReadSize)
+        if not res:
+            raise ConnectionResetError("socket closed by the device")
+        return res
+
+    # websocket (take whole frames at a time)
+    r, w, e = select.select([s], [], [], serialTimeout)
+    if not r:
+        return b''
+    opcode, websocket_res_buffer = s.recv_data()
+    if type(websocket_res_buffer) == str:
+        websocket_res_buffer = websocket_res_buffer.encode("utf8")
+    if opcode == 2:
+        return WebsocketBinary(websocket_res_buffer)
+    return websocket_res_buffer if opcode in (0, 1) else b''
+
+
+# the contents of a binary websocket frame, which carry WebREPL file transfers
+class WebsocketBinary(bytes):
+    pass
+
+
+# moves everything arriving on the connection into pending on its own thread, so that
+# waiting for the device is woken by the data arriving rather than polling with sleeps
+class DeviceReader(threading.Thread):
+    def __init__(self, s):
+        threading.Thread.__init__(self, name="DeviceReader", daemon=True)
+        self.s = s
+        self.pending = bytearray()
+        self.received_count = 0  # total bytes ever received, to tell when more have come in
+        self.error = None  # exception which stopped the reading, raised again in the reading functions
+        self.running = True
+        self.condition = threading.Condition()
+        self.recorder = None  # recording.SessionRecorder when the session is being recorded
+        self.binary = bytearray()  # binary websocket frames, while binary_frames is set for a WebREPL file transfer
+        self.binary_frames = False
+        self.flush_writes = None  # called before waiting for anything, when the writes to the device are buffered
+
+    def run(self):
+        while self.running:
+            try:
+                b = read_serial_available(self.s)
+            except Exception as e:
+                with self.condition:
+                    if self.running:
+                        self.error = e
+                    self.condition.notify_all()
+                break
+            if b:
+                if self.recorder is not None:
+                    self.recorder.received(b)
+                with self.condition:
+                    if self.binary_frames and type(b) == WebsocketBinary:
+                        self.binary.extend(b)
+                    else:
+                        self.pending.extend(b)
+                    self.received_count += len(b)
+                    if len(self.pending) > readerBufferMax:
+                        del self.pending[:len(self.pending) - readerBufferMax]
+                    self.condition.notify_all()
+
+    def stop(self):
+        self.running = False
+
+    def wait_for(self, predicate, timeout):
+        if self.flush_writes is not None:
+            self.flush_writes()
+        with self.condition:
+            return self.condition.wait_for(lambda: predicate() or self.error is not None, timeout)
+
+    def wait_for_quiet(self, quiet_time):
+        # returns once nothing new has arrived for quiet_time
+        while True:
+            received_count = self.received_count
+            if not self.wait_for(lambda: self.received_count != received_count, quiet_time) or self.error:
+                return
+
+    def take(self, n=None):
+        with self.condition:
+            if not self.pending and self.error:
+                raise self.error
+            n = len(self.pending) if n is None else n
+            res = bytes(self.pending[:n])
+            del self.pending[:n]
+            return res
+
+    def unread(self, b):
+        with self.condition:
+            self.pending[:0] = b
+
+
 # merge uncoming serial stream and break at OK, \x04, >, \r\n, and long delays
-# (must make this a member function so does not have to switch on the type of s)
-def yield_serial_chunk(s):
-    res = []
+# (the chunks are cut out of the reader's pending buffer, so anything after the last one yielded
+# is still there for DeviceConnector.working_serial_readall when the buffer is cleared)
+def yield_serial_chunk(reader):
     n = 0
-    websocket_res_buffer = b""
-    websocket_res_buffer_i = 0
+    idle_due = False  # set when something has been yielded since the last time it went quiet
     while True:
-        try:
-            if type(s) == serial.Serial:
-                b = s.read()
-            elif type(s) == socket.socket:
-                r, w, e = select.select([s], [], [], serialTimeout)
-                if r:
-                    b = s._sock.recv(1)
+        chunks = []
+        error = None
+        with reader.condition:
+            m = serialChunkDelimiters.search(reader.pending)
+            if m:
+                delimiter = m.group()
+                if delimiter == b'\r\n':
+                    chunks.append(bytes(reader.pending[:m.end()]))
                 else:
-                    b = b''
-
-            else:  # websocket (break down to individual bytes)
-                if websocket_res_buffer_i >= len(websocket_res_buffer):
-                    r, w, e = select.select([s], [], [], serialTimeout)
-                    if r:
-                        websocket_res_buffer = s.recv()
-                        # this comes as batches of strings, which beed to be broken to characters
-                        if type(websocket_res_buffer) == str:
-                            websocket_res_buffer = websocket_res_buffer.encode(
-                                "utf8")  # handle fact that strings come back from this interface
-                    else:
-                        websocket_res_buffer = b''
-                    websocket_res_buffer_i = 0
-
-                if len(websocket_res_buffer) > 0:
-                    b = websocket_res_buffer[websocket_res_buffer_i:websocket_res_buffer_i + 1]
-                    websocket_res_buffer_i += 1
+                    if m.start() != 0:
+                        chunks.append(bytes(reader.pending[:m.start()]))
+                    chunks.append(delimiter)
+                del reader.pending[:m.end()]
+            else:
+                received_count = reader.received_count
+                if reader.flush_writes is not None:
+                    reader.flush_writes()
+                if reader.condition.wait_for(lambda: reader.received_count != received_count or reader.error is not None,
+                                             (serialIdleTime if idle_due else serialTimeout)) \
+                        and reader.received_count != received_count:
+                    continue  # scan again with the new bytes
+                if idle_due and reader.error is None:
+                    idle_due = False
+                    chunks = None
                 else:
-                    b = b''
-        except serial.SerialException as e:
+                    error = reader.error
+                    if reader.pending:
+                        chunks.append(bytes(reader.pending))
+                        reader.pending.clear()
+
+        if chunks is None:
+            yield None  # gone quiet for serialIdleTime
+            continue
+        if chunks:
+            idle_due = True
+        for chunk in chunks:
+            yield chunk
+        if error is not None:
+            if not isinstance(error, serial.SerialException):
+                raise error
             yield b"\r\n**[ys] "
-            yield str(type(e)).encode("utf8")
+            yield str(type(error)).encode("utf8")
             yield b"\r\n**[ys] "
-            yield str(e).encode("utf8")
+            yield str(error).encode("utf8")
             yield b"\r\n\r\n"
             break
-
-        if not b:
-            if res and (res[0] != 'O' or len(res) > 3):
-                yield b''.join(res)
-                res.clear()
-            else:
-                n += 1
-                if (n % serialTimeoutCount) == 0:
-                    yield b''
-                    # yield a blank line every (serialtimeout*serialtimeoutcount) seconds
-
-        elif b == b'K' and len(res) >= 1 and res[-1] == b'O':
-            if len(res) > 1:
-                yield b''.join(res[:-1])
-            yield b'OK'
-            res.clear()
-        elif b == b'\x04' or b == b'>':
-            if res:
-                yield b''.join(res)
-            yield b
-            res.clear()
-        else:
-            res.append(b)
-            if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
-                yield b''.join(res)
-                res.clear()
-
+        if not chunks:
+            n += 1
+            if (n % serialTimeoutCount) == 0:
+                yield b''
+                # yield a blank line every (serialtimeout*serialtimeoutcount) seconds
+
+
+# for DeviceConnector.device_walk, which lists a whole tree in one execution: a tab separated line of
+# type (d or f), size, sha256 hexdigest (when asked for and the firmware has hashlib) and path for each entry
+deviceFileWalker = """def O_walk(d, r, h):
+  import os
+  for e in os.ilistdir(d):
+    p = d.rstrip('/') + '/' + e[0] if d else e[0]
+    if e[1] == 0x4000:
+      print('d\\t0\\t\\t' + p)
+      if r:
+        O_walk(p, r, h)
+    else:
+      print('f\\t%d\\t%s\\t%s' % (e[3] if len(e) > 3 else os.stat(p)[6], h(p) if h else '', p))
+"""
+
+# passed to O_walk when the sha256 of each file is wanted
+deviceFileHasher = """def O_sha(p):
+  try:
+    import hashlib
+    from binascii import hexlify
+  except ImportError:
+    return ''
+  s = hashlib.sha256()
+  b = bytearray(512)
+  m = memoryview(b)
+  f = open(p, 'rb')
+  while True:
+    n = f.readinto(b)
+    if not n:
+      break
+    s.update(m[:n])
+  f.close()
+  return hexlify(s.digest()).decode()
+"""
 
 class DeviceConnector:
     def __init__(self, sres, sres_sys):
@@ -103,42 +399,184 @@ class DeviceConnector:
         self.working_socket = None
         self.working_websocket = None
         self.working_serial_chunk = None
+        self.working_reader = None  # DeviceReader of whichever connection is open
+        self.working_broker_pid = None  # set when working_serial goes through a device broker
+        self.raw_paste_supported = None  # found out on entering paste mode
+        self.paste_mode_timing = []  # (phase, seconds, tries) from the last enter_paste_mode
+        self.trace = None  # tracing.IOTrace when %profile is on
+        self.recorder = None  # recording.SessionRecorder when %record is on
+        self.decompress_supported = False  # (found out when compressHelpers are installed)
+        self.webrepl_files = None  # whether the websocket answers WebREPL file transfers (None until tried)
+        self.helpers_installed = set()  # helper sources (blockTransferHelpers, deviceFileWalker) defined on the device
+        self.device_tree = devicetree.DeviceTree()  # what is known of the device's files
+        self.stderr_count = 0  # pieces of output on stderr, to tell when a command has failed on the device
         self.sres = sres  # two output functions borrowed across
         self.sres_sys = sres_sys
         self._esptool_command = None
 
     def working_serial_readall(self):
         # usually used to clear the incoming buffer, results are printed out rather than used
-        if self.working_serial:
-            return self.working_serial.read_all()
-
+        if self.working_reader is None:
+            return b''
         if self.working_websocket:
-            res = []
-            while True:
-                r, w, e = select.select([self.working_websocket], [], [],
-                                        0.2)  # add a timeout to the webrepl, which can be slow
-                if not r:
-                    break
-                res.append(self.working_websocket.recv())
-            return "".join(res)  # this is returning a text array, not bytes
-            # though a binary frame can be stipulated according to websocket.ABNF.OPCODE_MAP
-            # fix this when we see it
-
-        # socket case, get it all down
-        res = []
-        while True:
-            r, w, e = select.select([self.working_socket._sock], [], [], 0)
-            if not r:
-                break
-            res.append(self.working_socket._sock.recv(1000))
-            self.sres("Selected socket {}  {}\n".format(len(res), len(res[-1])))
-        return b"".join(res)
+            self.working_reader.wait_for_quiet(0.2)  # add a timeout to the webrepl, which can be slow
+            return self.working_reader.take().decode("utf8", "replace")  # this is returning text, not bytes
+        return self.working_reader.take()
+
+    def start_reader(self):
+        if self.working_socket:
+            self.working_reader = DeviceReader(self.working_socket.raw)  # (the reader takes from the socket itself)
+            self.working_reader.flush_writes = self.working_socket.flush
+        else:
+            self.working_reader = DeviceReader(self.working_serial or self.working_websocket)
+        self.record_connection()
+        self.working_reader.start()
+
+    def record_connection(self):
+        if self.recorder is not None and self.working_reader is not None:
+            self.working_reader.recorder = self.recorder
+            if self.working_serial:
+                self.recorder.wrap_write(self.working_serial, "write", "serial {} {}".format(
+                    self.working_serial.port, self.working_serial.baudrate))
+            elif self.working_websocket:
+                self.recorder.wrap_write(self.working_websocket, "send", "websocket")
+            else:
+                self.recorder.wrap_write(self.working_socket.raw, "write", "socket")  # (as it goes out of the buffer)
+
+    def start_recording(self, filename):
+        self.stop_recording()
+        self.recorder = recording.SessionRecorder(filename)
+        self.record_connection()  # (and any connection made later)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            if self.working_reader is not None:
+                self.working_reader.recorder = None
+            self.recorder.close()
+            self.recorder = None
+
+    def device_write(self, bytes_to_send):
+        if self.trace is not None:
+            self.trace.sent(len(bytes_to_send))
+        if self.working_serial:
+            self.working_serial.write(bytes_to_send)
+        elif self.working_websocket:
+            self.working_websocket.send(bytes_to_send)
+        else:
+            self.working_socket.write(bytes_to_send)  # (flushed when an answer is waited for)
+
+    def device_bytes_waiting(self):
+        return bool(self.working_reader.pending)
+
+    def read_device_bytes(self, n, timeout=serialTimeoutCount*serialTimeout):
+        # exact read (short only on timeout) which goes through the same buffer as yield_serial_chunk
+        reader = self.working_reader
+        reader.wait_for(lambda: len(reader.pending) >= n, timeout)
+        return reader.take(n)
+
+    def read_binary_frames(self, n, timeout=serialTimeoutCount*serialTimeout):
+        # exact read (short only on timeout) from the binary websocket frames of a WebREPL file transfer
+        reader = self.working_reader
+        reader.wait_for(lambda: len(reader.binary) >= n, timeout)
+        with reader.condition:
+            res = bytes(reader.binary[:n])
+            del reader.binary[:n]
+        return res
+
+    def read_device_until(self, terminator, timeout=serialTimeoutCount*serialTimeout):
+        reader = self.working_reader
+        reader.wait_for(lambda: terminator in reader.pending, timeout)
+        with reader.condition:
+            i = reader.pending.find(terminator)
+        return reader.take((i + len(terminator)) if i != -1 else None)
+
+    # send a whole program for execution from the raw REPL using raw paste mode (ctrl-E A ctrl-A),
+    # streaming it within the window the device advertises and topped up by its \x01 flow control bytes.
+    # Returns False without sending the program if the firmware doesn't have raw paste mode,
+    # otherwise the output follows as \x04-separated stdout and stderr (no OK) and the > prompt
+    def raw_paste_write(self, program):
+        self.device_write(b'\x05A\x01')
+        res = self.read_device_bytes(2)
+        if res != b'R\x01':
+            if res != b'R\x00':
+                # older firmware treated it as input, and the ctrl-A reprints the raw REPL banner
+                self.read_device_until(b'w REPL; CTRL-B to exit\r\n>')
+            self.raw_paste_supported = False
+            return False
+
+        self.raw_paste_supported = True
+        window_size = struct.unpack("<H", self.read_device_bytes(2))[0]
+        window_remain = window_size
+        i = 0
+        while i < len(program):
+            while window_remain == 0 or self.device_bytes_waiting():
+                b = self.read_device_bytes(1)
+                if b == b'\x01':
+                    window_remain += window_size
+                elif b == b'\x04':
+                    # device has ended the paste early, so acknowledge
+                    self.device_write(b'\x04')
+                    return True
+                elif b:
+                    self.sres("[unexpected {} during raw paste]".format(repr(b)), 31)
+                else:
+                    self.sres("[raw paste flow control timed out]", 31)
+                    window_remain = window_size
+            chunk = program[i:i + window_remain]
+            self.device_write(chunk)
+            window_remain -= len(chunk)
+            i += len(chunk)
+
+        self.device_write(b'\x04')
+        if self.trace is not None:
+            self.trace.executing()
+        self.read_device_until(b'\x04')  # the device acknowledges end of data before it compiles and runs it
+        if self.trace is not None:
+            self.trace.okay()
+        return True
+
+    def start_statements(self, statements):
+        # begin a single execution without waiting for it to finish, so the program can be talked to directly
+        program = b"".join(statements)
+        if self.raw_paste_supported and self.raw_paste_write(program):
+            return True
+        self.device_write(program)
+        self.device_write(b'\r\x04')
+        if self.trace is not None:
+            self.trace.executing()
+        res = self.read_device_bytes(2)
+        if res != b'OK':
+            self.sres("[missing-OK {}]".format(repr(res)), 31)
+            return False
+        if self.trace is not None:
+            self.trace.okay()
+        return True
+
+    def execute_statements(self, statements, fetch_file_capture_chunks=0):
+        # run a list of encoded source lines as a single execution
+        program = b"".join(statements)
+        if self.raw_paste_supported and self.raw_paste_write(program):
+            return self.receive_stream(seek_okay=False, fetch_file_capture_chunks=fetch_file_capture_chunks)
+        self.device_write(program)
+        self.device_write(b'\r\x04')
+        if self.trace is not None:
+            self.trace.executing()
+        return self.receive_stream(seek_okay=True, fetch_file_capture_chunks=fetch_file_capture_chunks)
 
     def disconnect(self, raw=False, verbose=False):
+        if self.working_broker_pid is not None:
+            raw = True  # leave the device in the raw REPL for the broker's next kernel
+            self.working_broker_pid = None
         if not raw:
             self.exit_paste_mode(verbose)  # this doesn't seem to do any good (paste mode is left on disconnect anyway)
 
         self.working_serial_chunk = None
+        if self.working_reader is not None:
+            self.working_reader.stop()
+        self.raw_paste_supported = None
+        self.webrepl_files = None
+        self.helpers_installed.clear()
+        self.device_tree.clear()
         if self.working_serial is not None:
             if verbose:
                 self.sres_sys("\nClosing serial {}\n".format(str(self.working_serial)))
@@ -152,9 +590,11 @@ class DeviceConnector:
             self.sres_sys("\nClosing websocket {}\n".format(str(self.working_websocket)))
             self.working_websocket.close()
             self.working_websocket = None
+        if self.working_reader is not None:
+            self.working_reader.join(serialTimeout*2)
+            self.working_reader = None
 
-    def serial_connect(self, portname, baudrate, verbose):
-        assert not self.working_serial
+    def choose_serial_port(self, portname):
         if type(portname) is int:
             port_index = portname
             possible_ports = guess_serial_port()
@@ -165,6 +605,11 @@ class DeviceConnector:
             else:
                 self.sres_sys("No possible ports found")
                 portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+        return portname
+
+    def serial_connect(self, portname, baudrate, verbose):
+        assert not self.working_serial
+        portname = self.choose_serial_port(portname)
 
         self.sres_sys("Connecting to --port={} --baud={} ".format(portname, baudrate))
         try:
@@ -178,6 +623,7 @@ class DeviceConnector:
             else:
                 self.sres_sys("\nAre you sure your ESP-device is plugged in?")
             return
+        self.start_reader()
 
         i = 0
         for i in range(5001):
@@ -194,6 +640,68 @@ class DeviceConnector:
         if i != 0 and verbose:
             self.sres("Waited {} seconds for isOpen()\n".format(i * 0.01))
 
+    def broker_connect(self, portname, baudrate, brokerport, verbose, wait=brokerWaitTimeout, spawn=True):
+        # attaches to the device broker on brokerport, starting one for portname first unless spawn is False
+        self.disconnect(verbose=verbose)
+        broker_url = "socket://127.0.0.1:{}".format(brokerport)
+        try:
+            self.working_serial = serial.serial_for_url(broker_url, timeout=serialTimeout)
+        except serial.SerialException:
+            if not spawn:
+                self.sres("No device broker running on {}\n".format(brokerport), 31)
+                return
+            portname = self.choose_serial_port(portname)
+            self.sres_sys("Starting device broker for --port={} --baud={} on {}\n".format(portname, baudrate, brokerport))
+            broker.spawn_broker(portname, baudrate, brokerport)
+            start_time = time.time()
+            while self.working_serial is None and time.time() - start_time < brokerStartTimeout:
+                time.sleep(0.05)
+                try:
+                    self.working_serial = serial.serial_for_url(broker_url, timeout=serialTimeout)
+                except serial.SerialException:
+                    pass
+            if self.working_serial is None:
+                self.sres("Device broker did not start (is --port={} right?)\n".format(portname), 31)
+                return
+        # (pyserial leaves Nagle on, which holds back each small write for the ack of the one before)
+        self.working_serial._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.working_serial.write(broker.brokerHello)  # the broker answers this when no other kernel is using it
+        self.start_reader()
+
+        greeting = self.read_device_until(b"\r\n", timeout=0.2)
+        if not greeting:
+            self.sres_sys("Waiting for the device broker (in use by another kernel)\n")
+            greeting = self.read_device_until(b"\r\n", timeout=wait)
+        greeting_fields = greeting.decode("utf8", "replace").split()
+        if not greeting.startswith(broker.brokerGreeting) or len(greeting_fields) != 5:
+            self.sres("No answer from a device broker on {}\n".format(brokerport), 31)
+            self.disconnect(raw=True)
+            return
+        self.working_broker_pid = int(greeting_fields[2])
+        self.sres_sys("Attached to device broker (pid {}) on --port={} --baud={}\n"
+                      .format(self.working_broker_pid, greeting_fields[3], greeting_fields[4]))
+        if type(portname) is str and portname != greeting_fields[3]:
+            self.sres("The broker on {} is connected to {}, not {}\n".format(brokerport, greeting_fields[3], portname), 31)
+
+    def replay_connect(self, filename, fast):
+        # a recording (from %record) in place of the device, which answers as it did when the same is sent
+        self.disconnect(raw=True)
+        try:
+            self.working_serial = recording.ReplaySerial(filename, fast=fast, timeout=serialTimeout)
+        except serial.SerialException as e:
+            self.sres("Cannot replay {}: {}\n".format(filename, e), 31)
+            return
+        self.raw_paste_supported = self.working_serial.raw_paste
+        self.start_reader()
+        self.sres_sys("Replaying {} ({} cells, {:.1f}s{})\n".format(
+            filename, len(self.working_serial.cells), self.working_serial.duration, (", fast" if fast else "")))
+
+    def stop_broker(self):
+        broker_pid = self.working_broker_pid
+        self.disconnect(raw=True)
+        os.kill(broker_pid, signal.SIGTERM)
+        self.sres_sys("Stopped device broker (pid {})\n".format(broker_pid))
+
     def socket_connect(self, ipnumber, portnumber):
         self.disconnect(verbose=True)
 
@@ -202,18 +710,23 @@ class DeviceConnector:
         try:
             self.sres("preconnect\n")
             s.connect(socket.getaddrinfo(ipnumber, portnumber)[0][-1])
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # (Ctrl-Cs and raw paste acks go straight away)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socketSendBufferSize)
             self.sres("Doing makefile\n")
-            self.working_socket = s.makefile('rwb', 0)
+            self.working_socket = s.makefile('wb', socketWriteBufferSize)
+            self.start_reader()
         except OSError as e:
             self.sres("Socket OSError {}".format(str(e)))
         except ConnectionRefusedError as e:
             self.sres("Socket ConnectionRefusedError {}".format(str(e)))
 
     def websocket_connect(self, websocket_url):
+        import websocket  # the old non async one (only imported here as it is slow to load)
         self.disconnect(verbose=True)
         try:
             self.working_websocket = websocket.create_connection(websocket_url, 5)
             self.working_websocket.settimeout(serialTimeout)
+            self.start_reader()
         except socket.timeout:
             self.sres("Websocket Timeout after 5 seconds {}\n".format(websocket_url))
         except ValueError as e:
@@ -225,50 +738,32 @@ class DeviceConnector:
         except websocket.WebSocketException as e:
             self.sres("WebSocketException {}\n".format(str(e)))
 
-    def esptool(self, esp_command, portname, binfile):
+    def esptool(self, esp_command, portnames, binfile, baud=None, jobs=None):
         self.disconnect(verbose=True)
-        if type(portname) is int:
+        if type(portnames) is int:
             possible_ports = guess_serial_port()
             if possible_ports:
-                portname = possible_ports[portname]
+                portnames = [possible_ports[portnames]]
                 if len(possible_ports) > 1:
                     self.sres("Found serial ports {}: \n".format(", ".join(possible_ports)))
             else:
                 self.sres("No possible ports found")
-                portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
+                portnames = [("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")]
 
         if self._esptool_command is None:
-            # this section for finding what the name of the command function is
-            # may print junk into the jupyter Lab logs
-            for command in ("esptool.py", "esptool"):
-                try:
-                    subprocess.check_call([command, "version"])
-                    self._esptool_command = command
-                    break
-                except (subprocess.CalledProcessError, OSError):
-                    pass
+            self._esptool_command = flashing.find_esptool()
             if self._esptool_command is None:
                 self.sres("esptool not found on path\n")
                 return
 
-        pargs = [self._esptool_command, "--port", portname]
-        if esp_command == "erase":
-            pargs.append("erase_flash")
-        if esp_command == "esp32":
-            pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
-            pargs.append(binfile)
-        if esp_command == "esp8266":
-            pargs.extend(["--baud", "460800", "write_flash", "--flash_size=detect", "-fm", "dio", "0"])
-            pargs.append(binfile)
+        pargs = flashing.esptool_args(self._esptool_command, esp_command, portnames[0], binfile,
+                                      baud or flashing.esptoolDefaultBauds.get(esp_command))
         self.sres_sys("Executing:\n  {}\n\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            x = line.decode()
-            self.sres(x)
-            if x[:12] == "Connecting..":
-                self.sres_sys("[Press the PRG button now if required]\n")
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
+        if len(portnames) > 1:
+            self.sres_sys("and the same on {}\n\n".format(", ".join(portnames[1:])))
+        boards = flashing.flash_boards(self.sres, self._esptool_command, esp_command, portnames, binfile, baud, jobs)
+        if any(board.status == "failed (exit -1)" for board in boards):
+            self._esptool_command = None
 
     def mpycross(self, mpycrossexe, pyfile):
         pargs = [mpycrossexe, pyfile]
@@ -286,13 +781,18 @@ class DeviceConnector:
         for j in range(2):
             # for restarting the chunk when interrupted
             if self.working_serial_chunk is None:
-                self.working_serial_chunk = yield_serial_chunk(
-                    self.working_serial or self.working_socket or self.working_websocket)
+                self.working_serial_chunk = yield_serial_chunk(self.working_reader)
 
             index_prev_greater_than_sign = -1
             # index04line = -1
-            for i, receive_line in enumerate(self.working_serial_chunk):
-                assert receive_line is not None
+            i = -1
+            for receive_line in self.working_serial_chunk:
+                if receive_line is None:
+                    self.sres("")  # lets sres send out what it is holding back
+                    continue
+                i += 1
+                if self.trace is not None:
+                    self.trace.received(receive_line)
 
                 # warning message when we are waiting on an OK
                 if seek_okay and warn_okay_priors and (receive_line != b'OK') and (
@@ -301,6 +801,8 @@ class DeviceConnector:
 
                 # the main interpreting loop
                 if receive_line == b'OK' and seek_okay:
+                    if self.trace is not None:
+                        self.trace.okay()
                     if i != 0 and warn_okay_priors:
                         self.sres("\n\n[Late OK]\n\n")
                     seek_okay = False
@@ -357,6 +859,8 @@ class DeviceConnector:
                                 self.sres("%d%% fetched\n" % int(len(res) / fetch_file_capture_chunks * 100 + 0.5),
                                           clear_output=True)
                         else:
+                            if n04count == 1 and ur.strip():
+                                self.stderr_count += 1
                             self.sres(ur, n04count=n04count)
 
             # else on the for-loop, means the generator has ended at a stop iteration
@@ -369,9 +873,16 @@ class DeviceConnector:
         return res if fetch_file_capture_chunks else True
 
     def send_to_file(self, destination_filename, mkdir, append, binary, quiet, file_contents):
-        if not (self.working_serial or self.working_websocket):
-            self.sres("File transfers not implemented for sockets\n", 31)
-            return
+        stderr_count = self.stderr_count
+        if self.working_websocket and self.webrepl_files is not False and not append:
+            if mkdir:
+                self.make_parent_dirs([destination_filename])
+            if self.webrepl_put_file(destination_filename, file_contents, quiet):
+                self.sent_to_file(destination_filename, mkdir, append, file_contents, stderr_count)
+                self.sres("Sent {} bytes to {}.\n".format(len(file_contents), destination_filename),
+                          clear_output=not quiet)
+            if self.webrepl_files is not False:
+                return
 
         lines = []
         if not binary:
@@ -382,39 +893,50 @@ class DeviceConnector:
                           31)
                 return
 
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        # in raw paste mode the statements are streamed in blocks of rawPasteBlockSize bytes per execution,
+        # otherwise every few statements are executed with a round trip to keep within the device's input buffer
+        if self.raw_paste_supported:
+            chunk_size, statements_per_execution = rawPasteChunkSize, None
+        else:
+            chunk_size, statements_per_execution = 30, (10 if binary else 5)
 
+        statements = []
         if mkdir:
             dseq = [d for d in destination_filename.split("/")[:-1] if d]
             if dseq:
-                working_device_write(b'import os\r\n')
+                statements.append(b'import os\r\n')
                 for i in range(len(dseq)):
-                    working_device_write('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i + 1]))).encode())
-                    working_device_write(b'except OSError:  pass\r\n')
+                    statements.append('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i + 1]))).encode())
+                    statements.append(b'except OSError:  pass\r\n')
 
         file_modifier = ("a" if append else "w") + ("b" if binary else "")
         if binary:
-            working_device_write(b"import ubinascii; O6 = ubinascii.a2b_base64\r\n")
-        working_device_write("O=open({}, '{}')\r\n".format(repr(destination_filename), file_modifier).encode())
-        working_device_write(b'\r\x04')  # intermediate execution
-        self.receive_stream(seek_okay=True)
+            statements.append(b"import ubinascii; O6 = ubinascii.a2b_base64\r\n")
+        statements.append("O=open({}, '{}')\r\n".format(repr(destination_filename), file_modifier).encode())
+        self.execute_statements(statements)  # intermediate execution
+        statements = []
+        statements_len = 0
         clear_output = True  # set this to False to help with debugging
+
+        def is_execution_due():
+            if statements_per_execution:
+                return len(statements) == statements_per_execution
+            return statements_len >= rawPasteBlockSize
+
         if binary:
             if type(file_contents) == str:
                 file_contents = file_contents.encode()
 
-            chunk_size = 30
             chunks_len = int(len(file_contents) / chunk_size)
 
             i = 0
             for i in range(chunks_len + 1):
                 chunk_bytes = file_contents[i * chunk_size:(i + 1) * chunk_size]
-                working_device_write(b'O.write(O6("')
-                working_device_write(binascii.b2a_base64(chunk_bytes)[:-1])
-                working_device_write(b'"))\r\n')
-                if (i % 10) == 9:
-                    working_device_write(b'\r\x04')  # intermediate executions
-                    self.receive_stream(seek_okay=True)
+                statements.append(b'O.write(O6("' + binascii.b2a_base64(chunk_bytes)[:-1] + b'"))\r\n')
+                statements_len += len(statements[-1])
+                if is_execution_due():
+                    self.execute_statements(statements)  # intermediate executions
+                    statements, statements_len = [], 0
                     if not quiet:
                         self.sres("{}%, chunk {}".format(int((i + 1) / (chunks_len + 1) * 100), i + 1),
                                   clear_output=clear_output)
@@ -423,31 +945,353 @@ class DeviceConnector:
 
         else:
             i = -1
-            line_chunk_size = 5
 
             if append:
-                working_device_write("O.write('\\n')\r\n".encode())  # avoid line concattenation on appends
+                statements.append("O.write('\\n')\r\n".encode())  # avoid line concattenation on appends
             for i, line in enumerate(lines):
-                working_device_write("O.write({})\r\n".format(repr(line)).encode())
-                if (i % line_chunk_size) == line_chunk_size - 1:
-                    working_device_write(b'\r\x04')  # intermediate executions
-                    self.receive_stream(seek_okay=True)
+                statements.append("O.write({})\r\n".format(repr(line)).encode())
+                statements_len += len(statements[-1])
+                if is_execution_due():
+                    self.execute_statements(statements)  # intermediate executions
+                    statements, statements_len = [], 0
                     if not quiet:
                         self.sres("{}%, line {}\n".format(int((i + 1) / (len(lines) + 1) * 100), i + 1),
                                   clear_output=clear_output)
             self.sres("Sent {} lines ({} bytes) to {}.\n".format(i + 1, len(file_contents), destination_filename),
                       clear_output=(clear_output and not quiet))
 
-        working_device_write("O.close()\r\n".encode())
-        working_device_write("del O\r\n".encode())
-        working_device_write(b'\r\x04')
-        self.receive_stream(seek_okay=True)
+        statements.append("O.close()\r\n".encode())
+        statements.append("del O\r\n".encode())
+        self.execute_statements(statements)
+        self.sent_to_file(destination_filename, mkdir, append, (file_contents if binary or not append else
+                                                                "\n" + file_contents), stderr_count)
+
+    def device_decompresses(self):
+        # installs the helpers for compressed transfers, returning whether the firmware can decompress
+        if compressHelpers not in self.helpers_installed:
+            lines = self.execute_statements([line.encode() + b'\r\n' for line in compressHelpers.splitlines()] +
+                                            [b"print(O_Z is not None)\r\n"], fetch_file_capture_chunks=-1)
+            self.helpers_installed.add(compressHelpers)
+            self.decompress_supported = (type(lines) == list and "True" in "".join(lines))
+        return self.decompress_supported
+
+    def webrepl_request(self, kind, filename, size):
+        # starts a WebREPL file transfer, returning the response code (0 for ok), or None with webrepl_files
+        # set to False if the device does not answer it at all
+        fname = filename.encode("utf8")
+        if len(fname) > 64:
+            self.sres("Filename too long for a WebREPL transfer {}\n".format(filename), 31)
+            return -1
+        with self.working_reader.condition:
+            self.working_reader.binary.clear()
+            self.working_reader.binary_frames = True
+        self.working_websocket.send_binary(webreplRequest.pack(b"WA", kind, 0, 0, size, len(fname), fname))
+        code = self.webrepl_response(webreplProbeTimeout if self.webrepl_files is None else None)
+        if code is None and self.webrepl_files is None:
+            self.working_reader.binary_frames = False
+            self.webrepl_files = False
+            self.device_write(b'\x03')  # (clears the request out of the raw REPL's line, if that is where it went)
+            self.read_device_until(b'>', timeout=serialTimeout)
+            self.sres("No answer to WebREPL file transfers, so sending through the REPL\n", 31)
+            return None
+        self.webrepl_files = True
+        return code
 
-    def fetch_file(self, source_filename, binary, quiet):
-        if not (self.working_serial or self.working_websocket):
-            self.sres("File transfers not implemented for sockets\n", 31)
+    def webrepl_response(self, timeout=None):
+        res = self.read_binary_frames(4, timeout or serialTimeoutCount*serialTimeout)
+        if len(res) != 4 or res[:2] != b"WB":
+            return None
+        return struct.unpack("<H", res[2:])[0]
+
+    def webrepl_put_file(self, destination_filename, file_contents, quiet):
+        # writes the file with WebREPL's own file transfer in binary frames, without going through the REPL.
+        # Returns whether it was written (check webrepl_files for it not being answered at all)
+        if type(file_contents) == str:
+            file_contents = file_contents.encode("utf8")
+        code = self.webrepl_request(webreplPutFile, destination_filename, len(file_contents))
+        if code is None and self.webrepl_files is False:
+            return False
+        if code == 0:
+            for i in range(0, len(file_contents), webreplBlockSize):
+                self.working_websocket.send_binary(file_contents[i:i + webreplBlockSize])
+                if not quiet:
+                    self.sres("{}%, {} bytes".format(int((i + webreplBlockSize) / len(file_contents) * 100),
+                                                     min(i + webreplBlockSize, len(file_contents))), clear_output=True)
+            code = self.webrepl_response()
+        self.working_reader.binary_frames = False
+        if code != 0:
+            self.sres("WebREPL could not write {} ({})\n".format(destination_filename,
+                                                                "no answer" if code is None else "error {}".format(code)), 31)
+            self.device_tree.forget(destination_filename)
+            return False
+        return True
+
+    def webrepl_get_file(self, source_filename, quiet):
+        # reads the file with WebREPL's own file transfer, returning its contents or None
+        code = self.webrepl_request(webreplGetFile, source_filename, 0)
+        res = bytearray()
+        while code == 0:
+            self.working_websocket.send_binary(b"\0")  # (for the next block)
+            header = self.read_binary_frames(2)
+            block = self.read_binary_frames(struct.unpack("<H", header)[0]) if len(header) == 2 else None
+            if block is None or len(block) != struct.unpack("<H", header)[0]:
+                code = None
+            elif not block:
+                code = self.webrepl_response()
+                break
+            else:
+                res.extend(block)
+                if not quiet:
+                    self.sres("{} bytes fetched".format(len(res)), clear_output=True)
+        self.working_reader.binary_frames = False
+        if code != 0:
+            if self.webrepl_files is not False:
+                self.sres("WebREPL could not read {} ({})\n".format(source_filename,
+                                                                   "no answer" if code is None else "error {}".format(code)), 31)
             return None
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        return bytes(res)
+
+    def make_parent_dirs(self, filenames):
+        # every directory the files would go in, in one execution
+        dirs = set()
+        for filename in filenames:
+            dseq = [d for d in filename.split("/")[:-1] if d]
+            dirs.update("/".join(dseq[:i + 1]) for i in range(len(dseq)))
+        if dirs:
+            self.install_helpers(batchTransferHelpers)
+            self.execute_statements(["O_mkdirs({})\r\n".format(repr(sorted(dirs))).encode()])
+
+    def send_files_webrepl(self, files, quiet):
+        # (after make_parent_dirs) returns the number sent, stopping at the first which fails
+        sent_count = 0
+        total_bytes = 0
+        for destination_filename, file_contents, binary in files:
+            stderr_count = self.stderr_count
+            if not self.webrepl_put_file(destination_filename, file_contents, True):
+                break
+            self.sent_to_file(destination_filename, True, False, file_contents, stderr_count)
+            total_bytes += len(file_contents)
+            sent_count += 1
+            self.sres("Sent {} bytes to {}.\n".format(len(file_contents), destination_filename), clear_output=not quiet)
+        if sent_count != len(files) and self.webrepl_files is not False:
+            self.sres("Stopped after an error, {} of {} files sent.\n".format(sent_count, len(files)), 31)
+        elif sent_count:
+            self.sres("Sent {} files ({} bytes) through WebREPL file transfers.\n".format(sent_count, total_bytes))
+        return sent_count
+
+    def send_files(self, files, mkdir, quiet, compress=False):
+        # sends [(destination_filename, file_contents, binary)] back to back, many small files to an execution,
+        # after making all their directories in one go.  Stops at the first error, returning the number sent
+        stderr_count = self.stderr_count
+        if mkdir:
+            self.make_parent_dirs([destination_filename for destination_filename, file_contents, binary in files])
+        if self.stderr_count != stderr_count:
+            return 0
+        if self.working_websocket and self.webrepl_files is not False:
+            sent_count = self.send_files_webrepl(files, quiet)  # (no need to compress, it goes as it is)
+            if self.webrepl_files is not False:
+                return sent_count
+        self.install_helpers(batchTransferHelpers)
+        if compress and not self.device_decompresses():
+            self.sres("No deflate or zlib on the device, so sending uncompressed\n", 31)
+            compress = False
+
+        if self.raw_paste_supported:
+            chunk_size, statements_per_execution = rawPasteChunkSize, None
+        else:
+            chunk_size, statements_per_execution = 30, 5
+        statements = []
+        statements_len = 0
+        closed = []  # files all of whose statements are in statements
+        sent_count = 0
+        compressed_count = 0
+        executions = 0
+        total_bytes = 0
+        sent_bytes = 0
+        # the files are encoded (and compressed) on a thread pool a few ahead of the one being sent
+        workers = os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            encodings = {}
+            for k in range(len(files)):
+                for ahead in range(k, min(k + 2 * workers, len(files))):
+                    if ahead not in encodings:
+                        encodings[ahead] = pool.submit(batch_file_statements, *files[ahead], chunk_size, compress)
+                file_statements, compressed = encodings.pop(k).result()
+                compressed_count += compressed
+                for j, statement in enumerate(file_statements):
+                    statements.append(statement)
+                    statements_len += len(statement)
+                    if j == len(file_statements) - 1:
+                        closed.append(k)
+                    if (len(statements) == statements_per_execution if statements_per_execution else
+                            statements_len >= rawPasteBlockSize):
+                        self.execute_statements(statements)
+                        executions += 1
+                        sent_bytes += statements_len
+                        statements, statements_len = [], 0
+                        if self.stderr_count != stderr_count:
+                            break
+                        for c in closed:
+                            total_bytes += self.sent_batch_file(files[c], mkdir, quiet)
+                        sent_count += len(closed)
+                        closed = []
+                        if not quiet:
+                            self.sres("{}%, file {} of {}".format(int(sent_count / len(files) * 100), sent_count,
+                                                                 len(files)), clear_output=True)
+                if self.stderr_count != stderr_count:
+                    for encoding in encodings.values():
+                        encoding.cancel()
+                    break
+        if statements and self.stderr_count == stderr_count:
+            self.execute_statements(statements)
+            executions += 1
+            sent_bytes += statements_len
+            if self.stderr_count == stderr_count:
+                for c in closed:
+                    total_bytes += self.sent_batch_file(files[c], mkdir, quiet)
+                sent_count += len(closed)
+
+        if self.stderr_count != stderr_count:
+            for destination_filename, file_contents, binary in files[sent_count:]:
+                self.device_tree.forget(destination_filename)  # (some of them could have been half written)
+            self.execute_statements([b"try:\r\n", b"  O.close()\r\n", b"except Exception:\r\n", b"  pass\r\n"])
+            self.sres("Stopped after an error, {} of {} files sent.\n".format(sent_count, len(files)), 31)
+        else:
+            self.sres("Sent {} files ({} bytes{}) as {} bytes in {} executions.\n".format(
+                sent_count, total_bytes, (", {} compressed".format(compressed_count) if compress else ""),
+                sent_bytes, executions))
+        return sent_count
+
+    def sent_batch_file(self, f, mkdir, quiet):
+        destination_filename, file_contents, binary = f
+        if type(file_contents) == str:
+            file_contents = file_contents.encode("utf8")
+        self.device_tree.wrote(destination_filename, file_contents, False, mkdir)
+        self.sres("Sent {} bytes to {}.\n".format(len(file_contents), destination_filename), clear_output=not quiet)
+        return len(file_contents)
+
+    def sent_to_file(self, destination_filename, mkdir, append, file_contents, stderr_count):
+        if self.stderr_count != stderr_count:
+            self.device_tree.forget(destination_filename)  # (some error on the device)
+            return
+        if type(file_contents) == str:
+            file_contents = file_contents.encode("utf8")
+        self.device_tree.wrote(destination_filename, file_contents, append, mkdir)
+
+    def install_block_helpers(self):
+        if self.working_websocket:
+            self.sres("Block transfers not implemented for websockets\n", 31)
+            return False
+        self.install_helpers(blockTransferHelpers)
+        return True
+
+    def install_helpers(self, helpers):
+        # defined once per raw REPL session rather than sent with every use
+        if helpers not in self.helpers_installed:
+            self.execute_statements([line.encode() + b'\r\n' for line in helpers.splitlines()])
+            self.helpers_installed.add(helpers)
+
+    def await_block_helper_ready(self):
+        ready = self.read_device_bytes(1)
+        if ready not in (b'R', b'r'):
+            # probably an exception, so put it back to be printed out with the rest of the traceback
+            self.working_reader.unread(ready)
+            self.receive_stream(seek_okay=False)
+            return None
+        return ready
+
+    def send_to_file_blocks(self, destination_filename, mkdir, append, quiet, file_contents,
+                            block_size=blockTransferSize, window=blockTransferWindow):
+        if self.working_websocket:
+            return self.send_to_file(destination_filename, mkdir, append, True, quiet, file_contents)
+        if not self.install_block_helpers():
+            return
+        if type(file_contents) == str:
+            file_contents = file_contents.encode()
+        stderr_count = self.stderr_count
+
+        if mkdir:
+            self.make_parent_dirs([destination_filename])
+        statements = ["O_put({}, '{}', {}, {}, {})\r\n".format(repr(destination_filename), "ab" if append else "wb",
+                                                                len(file_contents), block_size, window).encode()]
+        if not self.start_statements(statements) or not self.await_block_helper_ready():
+            self.device_tree.forget(destination_filename)
+            return
+
+        blocks = [file_contents[i:i + block_size] for i in range(0, len(file_contents), block_size)]
+        i = 0
+        resent_windows = 0
+        while i < len(blocks):
+            window_blocks = blocks[i:i + window]
+            for block in window_blocks:
+                self.device_write(struct.pack("<II", len(block), binascii.crc32(block)) + block)
+            ack = self.read_device_bytes(1)
+            if ack == b'A':
+                i += len(window_blocks)
+                if not quiet:
+                    self.sres("{}%, block {}".format(int(i / len(blocks) * 100), i), clear_output=True)
+            elif ack == b'E':
+                resent_windows += 1
+            else:
+                self.sres("\n[No acknowledgement for block {} {}]\n".format(i, repr(ack)), 31)
+                self.stderr_count += 1  # (so it is not taken as written)
+                break
+        self.receive_stream(seek_okay=False)
+        self.sent_to_file(destination_filename, mkdir, append, file_contents, stderr_count)
+        self.sres("Sent {} bytes in {} blocks ({} windows resent) to {}.\n"
+                  .format(len(file_contents), len(blocks), resent_windows, destination_filename), clear_output=not quiet)
+
+    def fetch_file_blocks(self, source_filename, quiet, block_size=blockTransferSize, window=blockTransferWindow):
+        if self.working_websocket:
+            return self.fetch_file(source_filename, True, quiet)
+        if not self.install_block_helpers():
+            return None
+        statements = ["O_get({}, {}, {})\r\n".format(repr(source_filename), block_size, window).encode()]
+        if not self.start_statements(statements):
+            return None
+        ready = self.await_block_helper_ready()
+        if not ready:
+            return None
+        check_crc = (ready == b'R')
+
+        bytes_num = struct.unpack("<I", self.read_device_bytes(4))[0]
+        res = bytearray()
+        resent_windows = 0
+        while len(res) < bytes_num:
+            window_blocks = []
+            good = True
+            for j in range(min(window, (bytes_num - len(res) + block_size - 1) // block_size)):
+                header = self.read_device_bytes(8)
+                if len(header) != 8:
+                    self.sres("\n[Timed out waiting for block at {}]\n".format(len(res)), 31)
+                    self.receive_stream(seek_okay=False)
+                    return None
+                block_len, block_crc = struct.unpack("<II", header)
+                block = self.read_device_bytes(block_len)
+                if len(block) != block_len or (check_crc and binascii.crc32(block) != block_crc):
+                    good = False
+                window_blocks.append(block)
+            if good:
+                res.extend(b"".join(window_blocks))
+                if not quiet:
+                    self.sres("{}% fetched\n".format(int(len(res) / bytes_num * 100)), clear_output=True)
+            else:
+                resent_windows += 1
+            self.device_write(b'A' if good else b'E')
+        self.receive_stream(seek_okay=False)
+        if not quiet:
+            self.sres("Fetched {}={} bytes from {} ({} windows resent).\n"
+                      .format(len(res), bytes_num, source_filename, resent_windows), clear_output=True)
+        return bytes(res)
+
+    def fetch_file(self, source_filename, binary, quiet):
+        if self.working_websocket and self.webrepl_files is not False:
+            res = self.webrepl_get_file(source_filename, quiet)
+            if self.webrepl_files is not False:
+                if res is not None and not quiet:
+                    self.sres("Fetched {} bytes from {}.\n".format(len(res), source_filename), clear_output=True)
+                return res
+        working_device_write = self.device_write
 
         if not binary:
             self.sres("non-binary mode not implemented, switching to binary")
@@ -485,40 +1329,65 @@ class DeviceConnector:
                           clear_output=True)
             return res
 
-    def working_device_list_dir(self, working_device_write, dirname):
-        working_device_write(b"import os,sys\r\n")
-        working_device_write(("for O in os.ilistdir(%s):\r\n" % repr(dirname)).encode())
-        working_device_write(b"  sys.stdout.write(repr(O))\r\n")
-        working_device_write(b"  sys.stdout.write('\\n')\r\n")
-        working_device_write(b"del O\r\n")
-        working_device_write(b'\r\x04')
-        k = self.receive_stream(seek_okay=True, fetch_file_capture_chunks=-1)
-        receive_list = []
-        try:
-            receive_list = list(map(ast.literal_eval, k))
-        except SyntaxError:
-            self.sres("Empty directory")
-        receive_list.sort()
-        for item in receive_list:
-            if item[1] == 0x4000:
-                self.sres("             %s/\n" % (dirname + '/' + item[0]).lstrip("/"))
-            else:
-                self.sres("%9d    %s\n" % (item[3], (dirname + '/' + item[0]).lstrip("/")))
-        return [dirname + "/" + item[0] for item in receive_list if item[1] == 0x4000]
-
-    def listdir(self, dirname, recurse):
-        self.sres("Listing directory '%s'.\n" % (dirname or '/'))
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
-        ld = self.working_device_list_dir(working_device_write, dirname)
-        if recurse:
-            while ld:
-                d = ld.pop(0)
-                self.sres("\n%s:\n" % d.lstrip("/"))
-                ld.extend(self.working_device_list_dir(working_device_write, d))
-        return None
+    def device_walk(self, dirname="", recurse=True, hashes=False):
+        # lists dirname (and everything below it if recurse) in one execution, returning [DeviceFile]
+        # with paths from the root and sha256 None unless asked for (and the firmware has hashlib)
+        self.install_helpers(deviceFileWalker)
+        if hashes:
+            self.install_helpers(deviceFileHasher)
+        statements = ["O_walk({}, {}, {})\r\n".format(repr(dirname), int(recurse), ("O_sha" if hashes else "None")).encode()]
+        k = self.execute_statements(statements, fetch_file_capture_chunks=-1)
+        res = []
+        complete = True
+        for line in k:
+            fields = line.rstrip("\r\n").split("\t", 3)
+            if len(fields) != 4 or fields[0] not in ("d", "f"):
+                self.sres(line)  # probably an error message
+                complete = False
+                continue
+            res.append(devicetree.DeviceFile(devicetree.device_path(fields[3]), ("dir" if fields[0] == "d" else "file"),
+                                             int(fields[1]), fields[2] or None))
+        if complete:
+            self.device_tree.add_listing(dirname, res, recurse)
+        return res
+
+    def listdir(self, dirname, recurse, refresh=False):
+        # answered from device_tree when everything asked for is known there
+        cached = not refresh and self.device_tree.is_listed(dirname, recurse)
+        self.sres("Listing directory '%s'%s.\n" % ((dirname or '/'), (" (cached)" if cached else "")))
+        entries = self.device_tree.listing(dirname, recurse) if cached else self.device_walk(dirname, recurse)
+        contents = collections.defaultdict(list)
+        for entry in entries:
+            contents[devicetree.parent_path(entry.path)].append(entry)
+        # printed a directory at a time, breadth first
+        top = devicetree.device_path(dirname)
+        ld = [top]
+        while ld:
+            d = ld.pop(0)
+            if d != top:
+                self.sres("\n%s:\n" % d)
+            for entry in sorted(contents[d]):
+                if entry.type == "dir":
+                    self.sres("             %s/\n" % entry.path)
+                    if recurse:
+                        ld.append(entry.path)
+                else:
+                    self.sres("%9d    %s\n" % (entry.size, entry.path))
+        return entries
+
+    def device_file_hashes(self, dirname=""):
+        # returns {path: (size, hexdigest or None where the firmware has no hashlib)} of every file in the tree
+        entries = None
+        if self.device_tree.is_listed(dirname, True):
+            entries = self.device_tree.listing(dirname, True)
+            if any(entry.type == "file" and entry.sha256 is None for entry in entries):
+                entries = None  # (listed without the hashes)
+        if entries is None:
+            entries = self.device_walk(dirname, True, True)
+        return {entry.path: (entry.size, entry.sha256) for entry in entries if entry.type == "file"}
 
     def mem_info(self):
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        working_device_write = self.device_write
         working_device_write(b"from micropython import mem_info\r\n")
         working_device_write(b"import sys\r\n")
         working_device_write(b"mem_info()\r\n")
@@ -542,19 +1411,24 @@ class DeviceConnector:
 
     def remove_file(self, filename):
         self.sres("Delete file: '%s'.\n" % filename)
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        working_device_write = self.device_write
         working_device_write(b"try:\r\n")
         working_device_write(b"  import os\r\n")
         working_device_write(b"except ImportError:\r\n")
         working_device_write(b"  import uos as os\r\n")
         working_device_write(("os.remove(%s)\r\n" % repr(filename)).encode())
         working_device_write(b'\r\x04')
+        stderr_count = self.stderr_count
         self.receive_stream(True)
+        if self.stderr_count == stderr_count:
+            self.device_tree.removed(filename)
+        else:
+            self.device_tree.forget(filename)
         return None
 
     def remove_dir(self, directory):
         self.sres("Delete directory: '%s'.\n" % directory)
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        working_device_write = self.device_write
         working_device_write(b"try:\r\n")
         working_device_write(b"  import os\r\n")
         working_device_write(b"except ImportError:\r\n")
@@ -578,23 +1452,28 @@ class DeviceConnector:
         working_device_write(("rmdir(%s)\r\n" % repr(directory)).encode())
         working_device_write(b'\r\x04')
         self.receive_stream(True)
+        self.device_tree.forget(directory)  # (files it could not remove are left without an error)
         return None
 
-    def enter_paste_mode(self, verbose=True):
+    def enter_paste_mode(self, verbose=True, prompt_timeout=replPromptTimeout, retries=replPromptRetries):
+        self.helpers_installed.clear()  # (lost on any reboot)
+        self.device_tree.clear()  # (boot.py and main.py could have changed the files)
         # now sort out connection situation
         if self.working_serial or self.working_websocket:
-            working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
-
-            msg = b'      '
-            i = 0
-            while (i < 10) or (msg[-6:] != b'\r\n>>> '):
-                time.sleep(0.2)  # try to give a moment to connect before issuing the Ctrl-C
-                working_device_write(b'\x03')  # ctrl-C: kill off running programs
-                working_device_write(b'\x03')  # ctrl-C: kill off running programs
-                working_device_write(b'\x03')  # ctrl-C: kill off running programs
-                time.sleep(0.1)
-                msg = self.working_serial_readall()
-                i += 1
+            # each phase returns as soon as what it waits for arrives, timings are kept in paste_mode_timing
+            self.paste_mode_timing = []
+            phase_start_time = time.time()
+            self.working_serial_readall()  # so an old prompt in the buffer is not taken as the answer
+
+            msg = b''
+            timeout = prompt_timeout
+            for i in range(retries):
+                self.device_write(b'\x03\x03\x03')  # ctrl-C: kill off running programs
+                msg = self.read_device_until(b'\r\n>>> ', timeout=timeout)
+                if msg[-6:] == b'\r\n>>> ':
+                    break
+                timeout = min(timeout * replPromptBackoff, replPromptMaxTimeout)  # give a slow boot longer
+            self.paste_mode_timing.append(("prompt", time.time() - phase_start_time, i + 1))
             if msg[-6:] == b'\r\n>>> ':
                 if verbose:
                     self.sres('repl is in normal command mode\n')
@@ -609,28 +1488,60 @@ class DeviceConnector:
             # self.working_serial.write(b'\r\x02')
             # ctrl-B: leave paste mode if still in it <-- doesn't work as when not in paste mode it reboots the device
 
-            working_device_write(b'\r\x01')
-            # ctrl-A: enter raw REPL
-            time.sleep(0.1)
-            msg = self.working_serial_readall()
-            if verbose and msg:
-                self.sres('\n[\\r\\x01] ')
-                self.sres(str(msg))
-            working_device_write(b'1\x04')
-            # single character program to run so receive stream works
+            self.enter_raw_repl(verbose)
+            return self.run_first_program(verbose)
+
+        # a socket is expected to be in the raw REPL already, but not after a soft reboot (and Ctrl-A
+        # just prints the banner again in the raw REPL)
+        self.paste_mode_timing = []
+        self.enter_raw_repl(verbose)
+        return self.run_first_program(verbose)
+
+    def enter_raw_repl(self, verbose):
+        phase_start_time = time.time()
+        self.device_write(b'\r\x01')
+        # ctrl-A: enter raw REPL (the answers to any extra Ctrl-Cs are skipped over)
+        msg = self.read_device_until(b'raw REPL; CTRL-B to exit\r\n>', timeout=rawReplBannerTimeout)
+        self.paste_mode_timing.append(("raw REPL", time.time() - phase_start_time, 1))
+        if verbose and msg:
+            self.sres('\n[\\r\\x01] ')
+            self.sres(str(msg))
+        return msg.endswith(b'raw REPL; CTRL-B to exit\r\n>')
+
+    def run_first_program(self, verbose):
+        phase_start_time = time.time()
+        if self.raw_paste_write(b'1'):
+            # single character program to run so receive stream works (this also detects raw paste mode)
+            if verbose:
+                self.sres('\nraw paste mode supported\n')
+            res = self.receive_stream(seek_okay=False, warn_okay_priors=False, five_second_timeout=True)
         else:
-            self.working_socket.write(b'1\x04')
-            # single character program "1" to run so receive stream works
-
-        return self.receive_stream(seek_okay=True, warn_okay_priors=False, five_second_timeout=True)
+            self.device_write(b'1\x04')
+            # single character program to run so receive stream works
+            res = self.receive_stream(seek_okay=True, warn_okay_priors=False, five_second_timeout=True)
+        self.paste_mode_timing.append(("first run", time.time() - phase_start_time, 1))
+        if verbose:
+            self.sres("\nhandshake: {}\n".format(", ".join(
+                "{} {:.3f}s{}".format(phase, t, " ({} tries)".format(n) if n > 1 else "")
+                for phase, t, n in self.paste_mode_timing)))
+        return res
+
+    def reattach_paste_mode(self, verbose=True):
+        # for a device broker's connection, where the last kernel left the device in the raw REPL;
+        # no Ctrl-Cs, so a running program and the variables are kept.  False if it needs enter_paste_mode
+        self.helpers_installed.clear()  # (can't tell what the last kernel did)
+        self.device_tree.clear()
+        self.paste_mode_timing = []
+        if not self.enter_raw_repl(verbose):
+            return False
+        return self.run_first_program(verbose)
 
     def exit_paste_mode(self, verbose):  # try to make it clean
         if self.working_serial or self.working_websocket:
-            working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+            working_device_write = self.device_write
             try:
                 working_device_write(b'\r\x03\x02')  # ctrl-C; ctrl-B to exit paste mode
-                time.sleep(0.1)
-                msg = self.working_serial_readall()
+                msg = self.read_device_until(b'>>> ', timeout=0.5)  # (returns as soon as the normal prompt is back)
             except serial.SerialException as e:
                 self.sres("serial exception on close {}\n".format(str(e)))
                 return
@@ -641,6 +1552,8 @@ class DeviceConnector:
                 self.sres(str(msg))
 
     def write_bytes(self, bytes_to_send):
+        if self.trace is not None:
+            self.trace.sent(len(bytes_to_send))
         if self.working_serial:
             working_serial_written = self.working_serial.write(bytes_to_send)
             return ("serial.write {} bytes to {} at baudrate {}\n"
@@ -650,6 +1563,7 @@ class DeviceConnector:
             return "serial.write {} bytes to {}\n".format(working_websocket_written, "websocket")
         else:
             working_socket_written = self.working_socket.write(bytes_to_send)
+            self.working_socket.flush()
             return "serial.write {} bytes to {}\n".format(working_socket_written, str(self.working_socket))
 
     # def terminate_running(self):
@@ -657,6 +1571,7 @@ class DeviceConnector:
     #     self.sres(str(self.working_serial_readall()))
     #     return None
     def send_reboot_message(self):
+        self.device_tree.clear()
         if self.working_serial:
             self.working_serial.write(b"\x03\r")  # quit any running program
             self.working_serial.write(b"\x02\r")  # exit the paste mode with ctrl-B
@@ -665,10 +1580,16 @@ class DeviceConnector:
             self.working_websocket.send(b"\x03\r")  # quit any running program
             self.working_websocket.send(b"\x02\r")  # exit the paste mode with ctrl-B
             self.working_websocket.send(b"\x04\r")  # soft reboot code
+        elif self.working_socket:
+            self.working_socket.write(b"\x03\r")  # quit any running program
+            self.working_socket.write(b"\x02\r")  # exit the paste mode with ctrl-B
+            self.working_socket.write(b"\x04\r")  # soft reboot code
+            self.working_socket.flush()  # (nothing is waited for after it)
 
     def send_hard_reset_message(self):
+        self.device_tree.clear()
         self.sres("Resetting Board...\n")
-        working_device_write = self.working_serial.write if self.working_serial else self.working_websocket.send
+        working_device_write = self.device_write
         working_device_write(b"import machine\r\n")
         working_device_write(b"machine.reset()\r\n")
         working_device_write(b'\r\x04')
@@ -676,6 +1597,8 @@ class DeviceConnector:
         return None
 
     def write_line(self, line):
+        if self.trace is not None:
+            self.trace.sent(len(line) + 2)
         if self.working_serial:
             self.working_serial.write(line.encode("utf8"))
             self.working_serial.write(b'\r\n')
@@ -686,5 +1609,37 @@ class DeviceConnector:
             self.working_socket.write(line.encode("utf8"))
             self.working_socket.write(b'\r\n')
 
+    def run_cell(self, cell_contents, bsuppressendcode=False):
+        self.device_tree.clear()  # (the program could change the files)
+        cmd_lines = cell_contents.splitlines(True)
+        r = self.working_serial_readall()
+        if r:
+            self.sres('[priorstuff] ')
+            self.sres(str(r))
+
+        # stream the whole cell in one go where the firmware has raw paste mode
+        if self.raw_paste_supported and not bsuppressendcode:
+            if self.raw_paste_write("\n".join(cell_contents.splitlines()).encode("utf8")):
+                self.receive_stream(seek_okay=False)
+                return
+
+        for line in cmd_lines:
+            if line:
+                if line[-2:] == '\r\n':
+                    line = line[:-2]
+                elif line[-1] == '\n':
+                    line = line[:-1]
+                self.write_line(line)
+                r = self.working_serial_readall()
+                if r:
+                    self.sres('[duringwriting] ')
+                    self.sres(str(r))
+
+        if not bsuppressendcode:
+            self.write_bytes(b'\r\x04')
+            if self.trace is not None:
+                self.trace.executing()
+            self.receive_stream(seek_okay=True)
+
     def serial_exists(self):
         return self.working_serial or self.working_socket or self.working_websocket
@@ -0,0 +1,88 @@
+import collections
+import hashlib
+import posixpath
+
+# the kernel's model of the device's file system, filled by listings and kept up to date by its own
+# writes and removals, so %ls and --sync can be answered without asking the device again.
+# It is only trusted between the kernel's own commands: DeviceConnector clears it on anything which
+# could change the files behind its back (running a cell, a reboot, reconnecting)
+
+DeviceFile = collections.namedtuple("DeviceFile", ["path", "type", "size", "sha256"])  # type is "dir" or "file"
+
+
+def device_path(path):
+    # relative to the root, as the kernel's commands use them ("" for the root)
+    return posixpath.normpath("/" + path).lstrip("/")
+
+
+def parent_path(path):
+    return path.rpartition("/")[0]
+
+
+class DeviceTree:
+    def __init__(self):
+        self.files = {}  # path: DeviceFile
+        self.listed = set()  # directories all of whose entries are in files
+
+    def clear(self):
+        self.files.clear()
+        self.listed.clear()
+
+    def below(self, d):
+        return [path for path in self.files if d == "" or path.startswith(d + "/")]
+
+    def add_listing(self, dirname, entries, recurse):
+        d = device_path(dirname)
+        for path in self.below(d):
+            if recurse or parent_path(path) == d:
+                del self.files[path]
+        self.listed.add(d)
+        for entry in entries:
+            path = device_path(entry.path)
+            self.files[path] = entry._replace(path=path)
+            if recurse and entry.type == "dir":
+                self.listed.add(path)
+
+    def is_listed(self, dirname, recurse):
+        d = device_path(dirname)
+        if d not in self.listed:
+            return False
+        return not recurse or all(path in self.listed for path in self.below(d) if self.files[path].type == "dir")
+
+    def listing(self, dirname, recurse):
+        d = device_path(dirname)
+        return [self.files[path] for path in sorted(self.below(d)) if recurse or parent_path(path) == d]
+
+    def wrote(self, path, file_contents, append, mkdir):
+        # after the kernel has written file_contents (bytes) to path without error
+        path = device_path(path)
+        if mkdir:
+            dseq = path.split("/")[:-1]
+            for i in range(len(dseq)):
+                d = "/".join(dseq[:i + 1])
+                if d not in self.files and parent_path(d) in self.listed:
+                    self.files[d] = DeviceFile(d, "dir", 0, None)
+                    self.listed.add(d)  # (new, so empty)
+        if parent_path(path) not in self.listed:
+            return  # (nothing would be answered from here anyway)
+        previous = self.files.get(path)
+        if append and previous is not None:
+            self.files[path] = DeviceFile(path, "file", previous.size + len(file_contents), None)
+        else:
+            self.files[path] = DeviceFile(path, "file", len(file_contents), hashlib.sha256(file_contents).hexdigest())
+
+    def removed(self, path):
+        path = device_path(path)
+        if path == "":
+            self.clear()
+            return
+        self.files.pop(path, None)
+        for p in self.below(path):
+            del self.files[p]
+        self.listed.discard(path)
+        self.listed.difference_update([d for d in self.listed if d.startswith(path + "/")])
+
+    def forget(self, path):
+        # the device did something unexpected with path, so it and its directory have to be listed again
+        self.removed(path)
+        self.listed.discard(parent_path(device_path(path)))
@@ -0,0 +1,190 @@
+import concurrent.futures
+import json
+import os
+import queue
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from .cache import default_cache_dir, read_cached, write_cached
+
+esptoolProbeTimeout = 30
+esptoolDefaultBauds = {"esp8266": 460800}  # otherwise esptool's own default
+esptoolFallbackBaud = 115200  # for a second try when flashing at a higher --baud fails
+esptoolProgressStep = 10  # percent between the progress lines shown for each board
+esptoolProgress = re.compile(r"\((\d+) ?%\)")
+esptoolOutputPoll = 0.05  # seconds between letting out output held back, while waiting for more from the boards
+esptoolWrote = re.compile(r"Wrote (\d+) bytes.* in ([\d.]+) seconds \(effective ([\d.]+) kbit/s\)")
+
+
+def esptool_cache_file():
+    return os.path.join(default_cache_dir("esptool"), "command.json")
+
+
+def command_stamp(command):
+    # what has to be unchanged for a cached command to be used without probing it again
+    path = shutil.which(command[0])
+    if path is None:
+        return None
+    return [os.path.realpath(path), os.stat(path).st_mtime_ns] + command[1:]
+
+
+def find_esptool():
+    # the command running esptool, remembered across kernel sessions as probing it takes seconds
+    cache_file = esptool_cache_file()
+    try:
+        cached = json.loads(read_cached(cache_file) or b"null")
+        if cached["stamp"] == command_stamp(cached["command"]):
+            return cached["command"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    for command in (["esptool.py"], ["esptool"], [sys.executable, "-m", "esptool"]):
+        stamp = command_stamp(command)
+        if stamp is None:
+            continue
+        try:
+            subprocess.run(command + ["version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=esptoolProbeTimeout, check=True)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+            continue
+        write_cached(cache_file, json.dumps({"command": command, "stamp": stamp}).encode("utf8"))  # (or probed again)
+        return command
+    return None
+
+
+def forget_esptool():
+    try:
+        os.remove(esptool_cache_file())
+    except OSError:
+        pass
+
+
+def esptool_args(command, esp_command, portname, binfile, baud):
+    pargs = command + ["--port", portname]
+    if baud:
+        pargs.extend(["--baud", str(baud)])
+    if esp_command == "erase":
+        pargs.append("erase_flash")
+    if esp_command == "esp32":
+        pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
+        pargs.append(binfile)
+    if esp_command == "esp8266":
+        pargs.extend(["write_flash", "--flash_size=detect", "-fm", "dio", "0"])
+        pargs.append(binfile)
+    return pargs
+
+
+# esptool run on one board, its output put on a queue (tagged with the board) for the kernel's
+# thread to print, as the iopub socket can't be used from the worker threads
+class FlashJob:
+    def __init__(self, name, portname):
+        self.name = name
+        self.portname = portname
+        self.status = "waiting"
+        self.baud = None
+        self.elapsed = 0.0
+        self.kbits = None  # effective kbit/s of the write, as esptool reports it
+        self.process = None
+        self.stopped = False
+
+    def run(self, command, esp_command, binfile, baud, output):
+        start_time = time.time()
+        bauds = [baud or esptoolDefaultBauds.get(esp_command)]
+        if baud and baud != esptoolFallbackBaud:
+            bauds.append(esptoolFallbackBaud)
+        for i, b in enumerate(bauds):
+            self.baud = b
+            self.status = "flashing"
+            returncode = self.run_esptool(esptool_args(command, esp_command, self.portname, binfile, b), output)
+            if returncode == 0:
+                self.status = "ok"
+                break
+            self.status = "failed (exit {})".format(returncode)
+            if self.stopped:
+                break
+            if i + 1 < len(bauds):
+                output.put((self, "[failed at {} baud, trying again at {}]\n".format(b, bauds[i + 1]), 0))
+        self.elapsed = time.time() - start_time
+
+    def run_esptool(self, pargs, output):
+        try:
+            self.process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            output.put((self, "{}\n".format(e), 1))
+            return -1
+        # both pipes at once, as esptool blocks once either is full
+        pumps = [threading.Thread(target=self.pump, args=(self.process.stdout, 0, output), daemon=True),
+                 threading.Thread(target=self.pump, args=(self.process.stderr, 1, output), daemon=True)]
+        for pump in pumps:
+            pump.start()
+        for pump in pumps:
+            pump.join()
+        return self.process.wait()
+
+    def pump(self, pipe, n04count, output):
+        shown_percent = -esptoolProgressStep
+        for line in iter(pipe.readline, b""):
+            x = line.decode("utf8", "replace")
+            progress = esptoolProgress.search(x)
+            if progress:
+                percent = int(progress.group(1))
+                if percent < shown_percent:
+                    shown_percent = -esptoolProgressStep  # (the next region, or verifying)
+                if percent - shown_percent < esptoolProgressStep and percent != 100:
+                    continue
+                shown_percent = percent
+            wrote = esptoolWrote.search(x)
+            if wrote:
+                self.kbits = float(wrote.group(3))
+            output.put((self, x, n04count))
+            if x[:12] == "Connecting..":
+                output.put((self, "[Press the PRG button now if required]\n", 0))
+        pipe.close()
+
+    def stop(self):
+        self.stopped = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+def flash_boards(sres, command, esp_command, portnames, binfile, baud=None, jobs=None):
+    # flashes every port at once (or jobs at a time), printing the output of each as it comes
+    boards = [FlashJob(os.path.basename(portname), portname) for portname in portnames]
+    tagged = len(boards) > 1
+    output = queue.Queue()
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(boards)) as executor:
+        futures = {executor.submit(board.run, command, esp_command, binfile, baud, output): board for board in boards}
+        try:
+            while not all(future.done() for future in futures) or not output.empty():
+                try:
+                    board, x, n04count = output.get(timeout=esptoolOutputPoll)
+                except queue.Empty:
+                    sres("")  # (lets out what sres is holding back, as esptool can be quiet for a while)
+                    continue
+                sres(("[{}] ".format(board.name) if tagged else "") + x, n04count=n04count)
+        except KeyboardInterrupt:
+            for board in boards:
+                board.stop()
+            raise
+        for future, board in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                board.status = "failed: {}".format(e)
+    wall_time = time.time() - start_time
+
+    sres("\n{:16}{:20}{:>8}{:>14}{:>10}\n".format("board", "status", "baud", "kbit/s", "time"), asciigraphicscode=34)
+    for board in boards:
+        sres("{:16}{:20}{:>8}{:>14}{:>9.1f}s\n".format(board.name, board.status, board.baud or "default",
+                                                      ("{:.1f}".format(board.kbits) if board.kbits else "-"),
+                                                      board.elapsed),
+             asciigraphicscode=(32 if board.status == "ok" else 31))
+    sres("{} boards in {:.1f}s\n".format(len(boards), wall_time))
+    if all(board.status == "failed (exit -1)" for board in boards):
+        forget_esptool()  # (could have been uninstalled since it was found)
+    return boards
@@ -0,0 +1,138 @@
+import concurrent.futures
+import fnmatch
+import os
+import time
+
+import serial
+
+from . import deviceconnector
+
+
+# one board of the fleet, with its own DeviceConnector whose output is collected rather than sent
+# to the notebook, as the iopub socket can't be used from the worker threads
+class FleetDevice:
+    def __init__(self, name, portname):
+        self.name = name
+        self.portname = portname
+        self.dc = deviceconnector.DeviceConnector(self.sres, self.sres_sys)
+        self.output = []  # (text, n04count)
+        self.status = "idle"
+        self.elapsed = 0.0
+
+    def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):
+        if output:
+            self.output.append((output, n04count))
+            if n04count != 0 and output.strip() and self.status == "running":
+                self.status = "error"  # something came out between the \x04s
+
+    def sres_sys(self, output, clear_output=False):
+        self.sres(output)
+
+    def take_output(self):
+        res = self.output
+        self.output = []
+        return res
+
+    def connect(self, baudrate):
+        start_time = time.time()
+        self.dc.serial_connect(self.portname, baudrate, False)
+        if not self.dc.working_serial:
+            self.status = "not connected"
+        else:
+            self.dc.write_bytes(b'\x03\x03\x03')
+            if self.dc.enter_paste_mode(verbose=False):
+                self.status = "ready"
+            else:
+                self.status = "paste mode not working"
+                self.dc.disconnect(raw=True)
+        self.elapsed = time.time() - start_time
+
+    def run_cell(self, cell_contents):
+        start_time = time.time()
+        self.status = "running"
+        try:
+            self.dc.run_cell(cell_contents)
+            if self.status == "running":
+                self.status = "ok"
+        except (OSError, serial.SerialException) as e:
+            self.status = "failed: {}".format(e)
+        self.elapsed = time.time() - start_time
+
+
+def fleet_ports(port_patterns):
+    # expands glob patterns against the serial ports found, leaving other names as they are
+    possible_ports = deviceconnector.guess_serial_port()
+    res = []
+    for pattern in port_patterns:
+        matched = [p for p in possible_ports if fnmatch.fnmatch(p, pattern)]
+        if not matched and not any(c in pattern for c in "*?["):
+            matched = [pattern]
+        res.extend(p for p in sorted(matched) if p not in res)
+    return res
+
+
+# several boards worked in parallel from one kernel, each on its own thread
+class DeviceFleet:
+    def __init__(self, sres):
+        self.sres = sres
+        self.devices = []
+
+    def exists(self):
+        return bool(self.devices)
+
+    def run_all(self, fn):
+        # calls fn(device) on every device at once, printing each device's output as it finishes
+        start_time = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.devices)) as executor:
+            futures = {executor.submit(fn, device): device for device in self.devices}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    device = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        device.status = "failed: {}".format(e)
+                    self.print_output(device)
+            except KeyboardInterrupt:
+                for device in self.devices:
+                    if device.dc.serial_exists():
+                        device.dc.write_bytes(b'\r\x03')
+                raise
+        return time.time() - start_time
+
+    def print_output(self, device):
+        tag = "[{}] ".format(device.name)
+        output = device.take_output()
+        for n04count in (0, 1):
+            text = "".join(o for o, n in output if (n != 0) == (n04count != 0))
+            lines = [line for line in text.splitlines() if line.strip()]
+            if lines:
+                self.sres("".join(tag + line + "\n" for line in lines), n04count=n04count)
+
+    def print_summary(self, wall_time):
+        self.sres("\n{:16}{:24}{:>10}\n".format("device", "status", "time"), asciigraphicscode=34)
+        for device in self.devices:
+            self.sres("{:16}{:24}{:>9.2f}s\n".format(device.name, device.status, device.elapsed),
+                      asciigraphicscode=(32 if device.status in ("ok", "ready") else 31))
+        self.sres("{} devices in {:.2f}s\n".format(len(self.devices), wall_time))
+
+    def connect(self, port_patterns, baudrate):
+        self.disconnect()
+        ports = fleet_ports(port_patterns)
+        if not ports:
+            self.sres("No ports match {}\n".format(" ".join(port_patterns)), 31)
+            return
+        self.devices = [FleetDevice(os.path.basename(port), port) for port in ports]
+        wall_time = self.run_all(lambda device: device.connect(baudrate))
+        self.print_summary(wall_time)
+        self.devices = [device for device in self.devices if device.status == "ready"]
+
+    def run_cell(self, cell_contents):
+        wall_time = self.run_all(lambda device: device.run_cell(cell_contents))
+        self.print_summary(wall_time)
+
+    def disconnect(self):
+        for device in self.devices:
+            device.dc.disconnect()
+            device.take_output()
+        self.devices = []
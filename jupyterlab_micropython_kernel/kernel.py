@@ -1,16 +1,26 @@
 # use of argparse for handling the %commands in the cells
 import argparse
+import collections
+import hashlib
 import logging
 import os
 import re
 import shlex
 import time
-import nbconvert
-import nbformat
-import websocket  # only for WebSocketConnectionClosedException
 from ipykernel.kernelbase import Kernel
 
+from . import broker
+from . import capture
 from . import deviceconnector
+from . import fleet
+from . import mpycache
+from . import notebookcache
+from . import symbolindex
+from . import tracing
+
+# stream output is held back and sent in one message once it is this old or this big
+sresFlushInterval = 0.05
+sresFlushBytes = 65536
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,6 +38,21 @@ ap_socket_connect = argparse.ArgumentParser(prog="%socketconnect", add_help=Fals
 ap_socket_connect.add_argument('--raw', help='Just open connection', action='store_true')
 ap_socket_connect.add_argument('ipnumber', type=str)
 ap_socket_connect.add_argument('portnumber', type=int)
+ap_socket_connect.add_argument('--verbose', action='store_true')
+
+ap_fleet_connect = argparse.ArgumentParser(prog="%fleetconnect", add_help=False)
+ap_fleet_connect.add_argument('--baud', type=int, default=115200)
+ap_fleet_connect.add_argument('ports', type=str, nargs='+', help='serial ports or glob patterns, eg /dev/ttyUSB*')
+
+ap_broker_connect = argparse.ArgumentParser(prog="%brokerconnect", add_help=False)
+ap_broker_connect.add_argument('--raw', help='Just attach to the broker', action='store_true')
+ap_broker_connect.add_argument('--port', type=str, default=0, help='serial port for the broker if it is not running')
+ap_broker_connect.add_argument('--baud', type=int, default=115200)
+ap_broker_connect.add_argument('--brokerport', type=int, default=broker.brokerPortDefault)
+ap_broker_connect.add_argument('--wait', type=float, default=deviceconnector.brokerWaitTimeout,
+                               help='seconds to wait for another kernel using the broker')
+ap_broker_connect.add_argument('--verbose', action='store_true')
+ap_broker_connect.add_argument('--stop', help='stop the broker, closing the serial port', action='store_true')
 
 ap_disconnect = argparse.ArgumentParser(prog="%disconnect", add_help=False)
 ap_disconnect.add_argument('--raw', help='Close connection without exiting paste mode', action='store_true')
@@ -56,6 +81,12 @@ ap_send_to_file.add_argument('--execute', '-x', action='store_true')
 ap_send_to_file.add_argument('--source', help="source file", type=str, default="<<cellcontents>>", nargs="?")
 ap_send_to_file.add_argument('--quiet', '-q', action='store_true')
 ap_send_to_file.add_argument('--QUIET', '-Q', action='store_true')
+ap_send_to_file.add_argument('--fast', '-f', help='send raw binary blocks through an on-device helper',
+                             action='store_true')
+ap_send_to_file.add_argument('--blocksize', type=int, default=deviceconnector.blockTransferSize)
+ap_send_to_file.add_argument('--window', type=int, default=deviceconnector.blockTransferWindow)
+ap_send_to_file.add_argument('--compress', '-z', help='send compressed, to be decompressed on the device',
+                             action='store_true')
 ap_send_to_file.add_argument('destinationfilename', type=str, nargs="?")
 
 ap_upload_main = argparse.ArgumentParser(prog="%uploadmain",
@@ -64,6 +95,8 @@ ap_upload_main = argparse.ArgumentParser(prog="%uploadmain",
                                          add_help=False)
 ap_upload_main.add_argument('--source', help='source file(.py/.ipynb)', type=str)
 ap_upload_main.add_argument('--reboot', '-r', help='hard reset after uploaded', action='store_true')
+ap_upload_main.add_argument('--compress', '-z', help='send compressed, to be decompressed on the device',
+                            action='store_true')
 
 ap_upload_project = argparse.ArgumentParser(prog="%uploadproject",
                                             description="upload all files in the specified folder to the"
@@ -73,10 +106,22 @@ ap_upload_project.add_argument('--source', help='project source directory', type
 ap_upload_project.add_argument('--reboot', '-r', help='hard reset after uploaded', action='store_true')
 ap_upload_project.add_argument('--emptydevice', '-e', help='empty device before uploaded', action='store_true')
 ap_upload_project.add_argument('--onlypy', '-py', help='Only upload all .py and .ipynb files', action='store_true')
+ap_upload_project.add_argument('--sync', '-s', help='only upload files whose size or sha256 differs on the device',
+                               action='store_true')
+ap_upload_project.add_argument('--delete', help='with --sync, remove device files not in the project',
+                               action='store_true')
+ap_upload_project.add_argument('--dryrun', '-n', help='with --sync, only report what would be transferred',
+                               action='store_true')
+ap_upload_project.add_argument('--mpy', '-m', help='cross-compile the .py files (except main.py and boot.py) and'
+                                                   ' upload them as .mpy', action='store_true')
+ap_upload_project.add_argument('--compress', '-z', help='send compressed, to be decompressed on the device',
+                               action='store_true')
 
 ap_ls = argparse.ArgumentParser(prog="%ls", description="list directory of the microcontroller's file system",
                                 add_help=False)
 ap_ls.add_argument('--recurse', '-r', action='store_true')
+ap_ls.add_argument('--refresh', help='list from the device, even where the files are already known',
+                   action='store_true')
 ap_ls.add_argument('dirname', type=str, nargs="?")
 
 ap_meminfo = argparse.ArgumentParser(prog="%meminfo", add_help=False)
@@ -99,6 +144,10 @@ ap_fetch_file.add_argument('--print', '-p', action="store_true")
 ap_fetch_file.add_argument('--load', '-l', action="store_true")
 ap_fetch_file.add_argument('--quiet', '-q', action='store_true')
 ap_fetch_file.add_argument('--QUIET', '-Q', action='store_true')
+ap_fetch_file.add_argument('--fast', '-f', help='fetch raw binary blocks through an on-device helper',
+                           action='store_true')
+ap_fetch_file.add_argument('--blocksize', type=int, default=deviceconnector.blockTransferSize)
+ap_fetch_file.add_argument('--window', type=int, default=deviceconnector.blockTransferWindow)
 ap_fetch_file.add_argument('sourcefilename', type=str)
 ap_fetch_file.add_argument('destinationfilename', type=str, nargs="?")
 
@@ -107,7 +156,10 @@ ap_mpycross.add_argument('--set-exe', type=str)
 ap_mpycross.add_argument('pyfile', type=str, nargs="?")
 
 ap_esptool = argparse.ArgumentParser(prog="%esptool", add_help=False)
-ap_esptool.add_argument('--port', type=str, default=0)
+ap_esptool.add_argument('--port', type=str, action='append',
+                        help='serial port or glob pattern, repeated for several boards flashed in parallel')
+ap_esptool.add_argument('--baud', type=int, help='flash at this baudrate, trying again at 115200 if it fails')
+ap_esptool.add_argument('--jobs', type=int, help='boards flashed at a time (default all)')
 ap_esptool.add_argument('espcommand', choices=['erase', 'esp32', 'esp8266'])
 ap_esptool.add_argument('binfile', type=str, nargs="?")
 
@@ -115,8 +167,36 @@ ap_capture = argparse.ArgumentParser(prog="%capture", description="capture outpu
                                      add_help=False)
 ap_capture.add_argument('--quiet', '-q', action='store_true')
 ap_capture.add_argument('--QUIET', '-Q', action='store_true')
+ap_capture.add_argument('--gzip', '-z', help='gzip the file as it is written', action='store_true')
+ap_capture.add_argument('--rotate', type=float, default=0,
+                        help='start a new numbered file after this many MB')
+ap_capture.add_argument('--columns', help='also save lines of delimited numbers as .npy arrays (needs numpy)',
+                        action='store_true')
+ap_capture.add_argument('--delimiter', type=str, default=',')
 ap_capture.add_argument('outputfilename', type=str)
 
+ap_tail = argparse.ArgumentParser(prog="%tail", description="show only the last lines printed by the device, redrawn "
+                                                          "at a limited rate", add_help=False)
+ap_tail.add_argument('--lines', '-n', type=int, default=20, help='number of lines kept')
+ap_tail.add_argument('--fps', type=float, default=4, help='redraws per second')
+
+ap_profile = argparse.ArgumentParser(prog="%profile", description="time the traffic with the device for each cell",
+                                     add_help=False)
+ap_profile.add_argument('action', choices=['on', 'off', 'show', 'clear'], nargs='?', default='show')
+ap_profile.add_argument('--json', type=str, help='save the timings and events of each cell to this file')
+ap_profile.add_argument('--chrome', type=str, help='save a Chrome trace (chrome://tracing, ui.perfetto.dev) file')
+
+ap_record = argparse.ArgumentParser(prog="%record", description="record every byte sent to and received from the "
+                                                                "device into a session file", add_help=False)
+ap_record.add_argument('--stop', help='stop recording and close the file', action='store_true')
+ap_record.add_argument('sessionfilename', type=str, nargs='?')
+
+ap_replay_connect = argparse.ArgumentParser(prog="%replayconnect", description="connect to a session recorded by "
+                                                                            "%record in place of the device",
+                                            add_help=False)
+ap_replay_connect.add_argument('--fast', help='answer without the recorded delays', action='store_true')
+ap_replay_connect.add_argument('sessionfilename', type=str)
+
 ap_write_file_pc = argparse.ArgumentParser(prog="%%writefile", description="write contents of cell to file on PC",
                                            add_help=False)
 ap_write_file_pc.add_argument('--append', '-a', action='store_true')
@@ -155,12 +235,25 @@ class MicroPythonKernel(Kernel):
         self.silent = False
         self.dc = deviceconnector.DeviceConnector(self.sres, self.sres_system)
         self.mpycrossexe = None
+        self.notebook_cache = notebookcache.NotebookCache()
+        self.mpy_cache = mpycache.MpyCache()
+        self.fleet = fleet.DeviceFleet(self.sres)
+        self.symbol_index = symbolindex.SymbolIndex(self.dc)
 
         self.srescapturemode = 0
         # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
         self.srescapturedoutputfile = None  # used by %capture command
-        self.srescapturedlinecount = 0
         self.srescapturedlasttime = 0  # to control the frequency of capturing reported
+        self.srestaillines = None  # deque of the last lines while in %tail mode
+        self.srestailpartial = ""  # line not yet finished
+        self.srestailcount = 0
+        self.srestailfps = 4
+        self.srestaillast = 0  # time of the last redraw
+        self.srestaildirty = False
+        self.srespending = []  # text held back by sres for one stream message
+        self.srespendingname = None  # "stdout" or "stderr"
+        self.srespendingbytes = 0
+        self.srespendingtime = 0
 
     def interpret_percent_line(self, percent_line, cell_contents):
         try:
@@ -176,6 +269,7 @@ class MicroPythonKernel(Kernel):
             apargs = parse_ap(ap_serial_connect, percentstringargs[1:])
 
             self.dc.disconnect(apargs.verbose)
+            connect_start_time = time.time()
             self.dc.serial_connect(apargs.port, apargs.baud, apargs.verbose)
             if self.dc.working_serial:
                 if not apargs.raw:
@@ -188,6 +282,8 @@ class MicroPythonKernel(Kernel):
                             self.dc.send_reboot_message()
                             self.dc.enter_paste_mode()
                         self.sres_system("\nReady.\n")
+                        if apargs.verbose:
+                            self.sres("Connected and ready in {:.3f}s\n".format(time.time() - connect_start_time))
                     else:
                         self.sres("Disconnecting [paste mode not working]\n", 31)
                         self.dc.disconnect(verbose=apargs.verbose)
@@ -206,7 +302,7 @@ class MicroPythonKernel(Kernel):
             if self.dc.working_websocket:
                 self.sres_system("** WebSocket connected **\n")
                 if not apargs.raw:
-                    pline = self.dc.working_websocket.recv()
+                    pline = self.dc.read_device_until(b'Password: ').decode("utf8", "replace")
                     self.sres(pline)
                     if pline == 'Password: ' and apargs.password is not None:
                         self.dc.working_websocket.send(apargs.password)
@@ -234,14 +330,69 @@ class MicroPythonKernel(Kernel):
                 if apargs.verbose:
                     self.sres(str(self.dc.working_socket))
                 self.sres("\n")
-                # if not apargs.raw:
-                #    self.dc.enterpastemode()
+                if not apargs.raw:
+                    # (the socket is in the raw REPL already, this finds out if it has raw paste mode)
+                    if self.dc.enter_paste_mode(verbose=apargs.verbose):
+                        self.sres_system("Ready.\n")
+                    else:
+                        self.sres("Disconnecting [paste mode not working]\n", 31)
+                        self.dc.disconnect(verbose=apargs.verbose)
+                        cell_contents = ""
+            else:
+                cell_contents = ""
+            return cell_contents.strip() and cell_contents or None
+
+        if percentcommand == ap_broker_connect.prog:
+            apargs = parse_ap(ap_broker_connect, percentstringargs[1:])
+            if not apargs:
+                self.sres(ap_broker_connect.format_help())
+                return None
+
+            connect_start_time = time.time()
+            self.dc.broker_connect(apargs.port, apargs.baud, apargs.brokerport, apargs.verbose, apargs.wait,
+                                   spawn=not apargs.stop)  # (nothing to stop if it is not running)
+            if self.dc.working_broker_pid is not None and apargs.stop:
+                self.dc.stop_broker()
+                return None
+            if self.dc.working_broker_pid is not None:
+                if not apargs.raw:
+                    if self.dc.reattach_paste_mode(verbose=apargs.verbose):
+                        self.sres_system("\nReady (reattached).\n")
+                    elif self.dc.enter_paste_mode(verbose=apargs.verbose):
+                        self.sres_system("\nReady.\n")
+                    else:
+                        self.sres("Disconnecting [paste mode not working]\n", 31)
+                        self.dc.disconnect(verbose=apargs.verbose)
+                        cell_contents = ""
+                    if apargs.verbose:
+                        self.sres("Connected and ready in {:.3f}s\n".format(time.time() - connect_start_time))
+            else:
+                cell_contents = ""
             return cell_contents.strip() and cell_contents or None
 
+        if percentcommand == ap_fleet_connect.prog:
+            apargs = parse_ap(ap_fleet_connect, percentstringargs[1:])
+            if apargs:
+                self.fleet.connect(apargs.ports, apargs.baud)
+            else:
+                self.sres(ap_fleet_connect.format_help())
+            return cell_contents.strip() and cell_contents or None
+
+        if percentcommand == "%fleetdisconnect":
+            self.fleet.disconnect()
+            self.sres_system("Fleet disconnected\n")
+            return None
+
         if percentcommand == ap_esptool.prog:
             apargs = parse_ap(ap_esptool, percentstringargs[1:])
             if apargs and (apargs.espcommand == "erase" or apargs.binfile):
-                self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile)
+                portnames = fleet.fleet_ports(apargs.port) if apargs.port else 0
+                if not portnames:
+                    self.sres("No ports match {}\n".format(" ".join(apargs.port)), 31)
+                    return None
+                if self.fleet.exists():
+                    self.fleet.disconnect()  # (its ports could be among them)
+                self.dc.esptool(apargs.espcommand, portnames, apargs.binfile, apargs.baud, apargs.jobs)
             else:
                 self.sres(ap_esptool.format_help())
                 self.sres("Please download the bin file from https://micropython.org/download/#{}".format(
@@ -288,6 +439,50 @@ class MicroPythonKernel(Kernel):
             self.sres(" ".join(percentstringargs[1:]), asciigraphicscode=32)
             return cell_contents.strip() and cell_contents or None
 
+        if percentcommand == ap_profile.prog:
+            apargs = parse_ap(ap_profile, percentstringargs[1:])
+            if not apargs:
+                self.sres(ap_profile.format_help())
+                return None
+            if apargs.action == "on" or (apargs.action == "clear" and self.dc.trace is not None):
+                self.dc.trace = tracing.IOTrace()
+                self.sres_system("Profiling the following cells\n")
+            if self.dc.trace is None:
+                self.sres("Profiling is off (%profile on)\n", 31)
+                return None
+            if apargs.action in ("show", "off"):
+                self.sres(self.dc.trace.summary_table())
+            if apargs.json:
+                self.dc.trace.save_json(apargs.json)
+                self.sres_system("Saved {}\n".format(apargs.json))
+            if apargs.chrome:
+                self.dc.trace.save_chrome_trace(apargs.chrome)
+                self.sres_system("Saved {}\n".format(apargs.chrome))
+            if apargs.action == "off":
+                self.dc.trace = None
+            return None
+
+        if percentcommand == ap_record.prog:
+            apargs = parse_ap(ap_record, percentstringargs[1:])
+            if not apargs or not (apargs.stop or apargs.sessionfilename):
+                self.sres(ap_record.format_help())
+                return None
+            if self.dc.recorder is not None:
+                self.sres_system("Recorded {} into {}\n".format(self.dc.recorder.stats(), self.dc.recorder.filename))
+                self.dc.stop_recording()
+            if apargs.sessionfilename:
+                self.dc.start_recording(apargs.sessionfilename)
+                self.sres_system("Recording the session into {}\n".format(apargs.sessionfilename))
+            return cell_contents.strip() and cell_contents or None
+
+        if percentcommand == ap_replay_connect.prog:
+            apargs = parse_ap(ap_replay_connect, percentstringargs[1:])
+            if not apargs:
+                self.sres(ap_replay_connect.format_help())
+                return None
+            self.dc.replay_connect(apargs.sessionfilename, apargs.fast)
+            return cell_contents.strip() and cell_contents or None
+
         if percentcommand == "%lsmagic":
             self.sres(re.sub("usage: ", "", ap_serial_connect.format_usage()))
             self.sres("    connects to a device over USB wire\n\n")
@@ -300,6 +495,11 @@ class MicroPythonKernel(Kernel):
             self.sres("    websocketurl defaults to ws://192.168.4.1:8266 but be sure to be connected\n\n")
             self.sres(re.sub("usage: ", "", ap_disconnect.format_usage()))
             self.sres("    disconnects from web/serial connection\n\n")
+            self.sres(re.sub("usage: ", "", ap_broker_connect.format_usage()))
+            self.sres("    connects through a broker process which keeps the device open across kernel restarts\n\n")
+            self.sres(re.sub("usage: ", "", ap_fleet_connect.format_usage()))
+            self.sres("    connects to several devices and runs the following cells on all of them at once\n\n")
+            self.sres("%fleetdisconnect\n    disconnects all the devices of the fleet\n\n")
 
             self.sres("%rebootdevice\n    reboots device\n\n")
             self.sres("%hardreset\n    A hard reset is the same as performing a power cycle to the board. \n\n")
@@ -332,9 +532,17 @@ class MicroPythonKernel(Kernel):
             self.sres("    commands for flashing your esp-device\n\n")
             self.sres(re.sub("usage: ", "", ap_capture.format_usage()))
             self.sres("    records output to a file\n\n")
+            self.sres(re.sub("usage: ", "", ap_tail.format_usage()))
+            self.sres("    shows only the last lines of output, for programs which print without end\n\n")
             self.sres("%comment\n    print this into output\n\n")
             self.sres(re.sub("usage: ", "", ap_mpycross.format_usage()))
             self.sres("    cross-compile a .py file to a .mpy file\n\n")
+            self.sres(re.sub("usage: ", "", ap_profile.format_usage()))
+            self.sres("    times sending, first byte back, OK and the whole of each cell\n\n")
+            self.sres(re.sub("usage: ", "", ap_record.format_usage()))
+            self.sres("    records the traffic with the device into a session file\n\n")
+            self.sres(re.sub("usage: ", "", ap_replay_connect.format_usage()))
+            self.sres("    connects to a recorded session, which answers the cells run again as the device did\n\n")
             self.sres("%lsmagic\n    list magic commands\n\n")
 
             return None
@@ -352,13 +560,31 @@ class MicroPythonKernel(Kernel):
             apargs = parse_ap(ap_capture, percentstringargs[1:])
             if apargs:
                 self.sres("Writing output to file {}\n\n".format(apargs.outputfilename), asciigraphicscode=32)
-                self.srescapturedoutputfile = open(apargs.outputfilename, "w")
+                try:
+                    self.srescapturedoutputfile = capture.CaptureWriter(
+                        apargs.outputfilename, compress=apargs.gzip, rotate_bytes=int(apargs.rotate * 1e6),
+                        columns=apargs.columns, delimiter=apargs.delimiter)
+                except ImportError:
+                    self.sres("--columns needs numpy installed\n", 31)
+                    return None
                 self.srescapturemode = (3 if apargs.QUIET else (2 if apargs.quiet else 1))
-                self.srescapturedlinecount = 0
             else:
                 self.sres(ap_capture.format_help())
             return cell_contents
 
+        if percentcommand == ap_tail.prog:
+            apargs = parse_ap(ap_tail, percentstringargs[1:])
+            if apargs and apargs.lines > 0 and apargs.fps > 0:
+                self.srestaillines = collections.deque(maxlen=apargs.lines)
+                self.srestailpartial = ""
+                self.srestailcount = 0
+                self.srestailfps = apargs.fps
+                self.srestaillast = 0
+                self.srestaildirty = False
+            else:
+                self.sres(ap_tail.format_help())
+            return cell_contents
+
         if percentcommand == ap_write_bytes.prog:
             # (not effectively using the --binary setting)
             apargs = parse_ap(ap_write_bytes, percentstringargs[1:])
@@ -426,7 +652,11 @@ class MicroPythonKernel(Kernel):
         if percentcommand == ap_fetch_file.prog:
             apargs = parse_ap(ap_fetch_file, percentstringargs[1:])
             if apargs:
-                fetchedcontents = self.dc.fetch_file(apargs.sourcefilename, apargs.binary, apargs.quiet)
+                if apargs.fast:
+                    fetchedcontents = self.dc.fetch_file_blocks(apargs.sourcefilename, apargs.quiet,
+                                                                apargs.blocksize, apargs.window)
+                else:
+                    fetchedcontents = self.dc.fetch_file(apargs.sourcefilename, apargs.binary, apargs.quiet)
                 if apargs.print:
                     self.sres(fetchedcontents.decode() if type(fetchedcontents) == bytes else fetchedcontents,
                               clear_output=True)
@@ -434,7 +664,7 @@ class MicroPythonKernel(Kernel):
                 if (apargs.destinationfilename or (not apargs.print and not apargs.load)) and fetchedcontents:
                     dst_file = apargs.destinationfilename or os.path.basename(apargs.sourcefilename)
                     self.sres("Saving file to {}".format(repr(dst_file)))
-                    file_out = open(dst_file, "wb" if apargs.binary else "w")
+                    file_out = open(dst_file, "wb" if type(fetchedcontents) == bytes else "w")
                     file_out.write(fetchedcontents)
                     file_out.close()
 
@@ -452,7 +682,7 @@ class MicroPythonKernel(Kernel):
         if percentcommand == ap_ls.prog:
             apargs = parse_ap(ap_ls, percentstringargs[1:])
             if apargs:
-                self.dc.listdir(apargs.dirname or "", apargs.recurse)
+                self.dc.listdir(apargs.dirname or "", apargs.recurse, apargs.refresh)
             else:
                 self.sres(ap_ls.format_help())
             return None
@@ -487,10 +717,19 @@ class MicroPythonKernel(Kernel):
                     apargs.source is not None):
 
                 dest_file_name = apargs.destinationfilename
+                reset_after = [False]  # set by a send that resets the board (not --fast)
 
                 def send_to_file(filename, contents):
-                    self.dc.send_to_file(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents)
-                    self.dc.send_hard_reset_message()
+                    reset_after[0] = not apargs.fast
+                    if apargs.fast:
+                        self.dc.send_to_file_blocks(filename, apargs.mkdir, apargs.append, apargs.quiet, contents,
+                                                    apargs.blocksize, apargs.window)
+                    elif apargs.compress and not apargs.append:
+                        self.dc.send_files([(filename, contents, apargs.binary)], apargs.mkdir, apargs.quiet,
+                                           compress=True)
+                    else:
+                        self.dc.send_to_file(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet,
+                                             contents)
 
                 if apargs.source == "<<cellcontents>>":
                     file_contents = cell_contents
@@ -514,8 +753,9 @@ class MicroPythonKernel(Kernel):
                     elif os.path.isdir(apargs.source):
                         if apargs.execute:
                             self.sres("Cannot execute folder\n", 31)
-                        for root, dirs, files in os.walk(apargs.source):
-                            for fn in files:
+                        files = []
+                        for root, dirs, fns in os.walk(apargs.source):
+                            for fn in fns:
                                 skip = False
                                 fp = os.path.join(root, fn)
                                 real_path = os.path.relpath(fp, apargs.source)
@@ -525,8 +765,19 @@ class MicroPythonKernel(Kernel):
                                         skip = True
                                 if not skip:
                                     dest_path = os.path.join(dest_file_name, real_path).replace('\\', '/')
-                                    file_contents = open(os.path.join(root, fn), mode).read()
-                                    send_to_file(dest_path, file_contents)
+                                    files.append((dest_path, open(os.path.join(root, fn), mode).read(),
+                                                  apargs.binary))
+                        if apargs.fast or apargs.append:
+                            for dest_path, file_contents, binary in files:
+                                send_to_file(dest_path, file_contents)
+                        elif files:
+                            self.dc.send_files(files, apargs.mkdir, apargs.quiet, apargs.compress)  # (all in one go)
+                            reset_after[0] = True
+
+                    else:
+                        self.sres("No such file or directory: {}\n".format(apargs.source), 31)
+                if reset_after[0]:
+                    self.dc.send_hard_reset_message()  # (once, after everything is sent)
             else:
                 self.sres(ap_send_to_file.format_help())
             return cell_contents  # allows for repeat %send_to_file in same cell
@@ -537,7 +788,7 @@ class MicroPythonKernel(Kernel):
                 if (not source.endswith(".py")) and (not source.endswith(".ipynb")):
                     self.sres("you must choose a .py or .ipynb file")
                     return None
-                self.upload_file(source)
+                self.upload_file(source, compress=apargs.compress)
                 if apargs.reboot:
                     self.dc.send_hard_reset_message()
                     self.dc.enter_paste_mode()
@@ -555,7 +806,15 @@ class MicroPythonKernel(Kernel):
                     return None
                 if apargs.emptydevice:
                     self.dc.remove_dir(".")
-                self.upload_dir(apargs.source, apargs.onlypy)
+                if apargs.sync:
+                    self.sync_dir(apargs.source, apargs.onlypy, apargs.delete, apargs.dryrun, apargs.mpy,
+                                  apargs.compress)
+                else:
+                    self.upload_dir(apargs.source, apargs.onlypy, apargs.mpy, apargs.compress)
+                if self.notebook_cache.hits or self.notebook_cache.misses:
+                    self.sres("\n{}\n".format(self.notebook_cache.stats()))
+                if apargs.mpy and (self.mpy_cache.hits or self.mpy_cache.misses):
+                    self.sres("{}\n".format(self.mpy_cache.stats()))
                 if apargs.reboot:
                     self.dc.send_hard_reset_message()
                     self.dc.enter_paste_mode()
@@ -567,61 +826,133 @@ class MicroPythonKernel(Kernel):
         self.sres("Unrecognized percentline {}\n".format([percent_line]), 31)
         return cell_contents
 
-    def upload_file(self, source, mkdir=False, append=False, binary=False, quiet=True, root=""):
+    def upload_contents(self, source, binary=False, root=""):
+        # returns the destination path on the device and the contents to send for a local file
+        destination = source
+        root_len = len(root)
+        if root != "" and root_len+1 < len(source) and source[:root_len] == root:
+            destination = destination[root_len+1:]
+        if destination.endswith(".ipynb"):
+            file_contents = self.notebook_cache.convert(source)
+            destination = destination.replace(".ipynb", ".py")
+        else:
+            file_contents = open(source, "rb" if binary else "r").read()
+        return destination, file_contents
+
+    def upload_file(self, source, mkdir=False, append=False, binary=False, quiet=True, root="", compress=False):
         if os.path.exists(source) and os.path.isfile(source):
-            destination = source
-            root_len = len(root)
-            if root != "" and root_len+1 < len(source) and source[:root_len] == root:
-                destination = destination[root_len+1:]
-            if destination.endswith(".ipynb"):
-                notebook = nbformat.read(source, as_version=4)
-                py_exporter = nbconvert.PythonExporter()
-
-                output, resources = py_exporter.from_notebook_node(notebook)
-                file_contents = output.replace("get_ipython().run_line_magic", "# %")
-                destination = destination.replace(".ipynb", ".py")
-            else:
-                file_contents = open(source, "r").read()
+            destination, file_contents = self.upload_contents(source, binary, root)
             self.sres("\n\nuploading '{0}'\n".format(destination))
-            self.dc.send_to_file(destination, mkdir=mkdir, append=append, binary=binary,
-                                 quiet=quiet, file_contents=file_contents)
+            if compress and not append:
+                self.dc.send_files([(destination, file_contents, binary)], mkdir, quiet, compress=True)
+            else:
+                self.dc.send_to_file(destination, mkdir=mkdir, append=append, binary=binary,
+                                     quiet=quiet, file_contents=file_contents)
         else:
             self.sres("'{0}' is not a file\n\n".format(source))
 
-    def upload_dir(self, source, onlypy):
-        if os.path.exists(source) and os.path.isdir(source):
-            for root, dirs, files in os.walk(source, topdown=False):
-                if onlypy:
-                    files = [f for f in files if (not f[0] == '.' ) and ("/." not in root) and (f.endswith('.py') or f.endswith('.ipynb'))]
-                else:
-                    files = [f for f in files if (not f[0] == '.') and ("/." not in root)]
-                for f in files:
-                    self.upload_file(os.path.join(root, f), mkdir=True, binary=f.endswith(".mpy"), root=source)
-        else:
+    def project_files(self, source, onlypy):
+        for root, dirs, files in os.walk(source, topdown=False):
+            if onlypy:
+                files = [f for f in files if (not f[0] == '.' ) and ("/." not in root) and (f.endswith('.py') or f.endswith('.ipynb'))]
+            else:
+                files = [f for f in files if (not f[0] == '.') and ("/." not in root)]
+            for f in files:
+                yield os.path.join(root, f)
+
+    def project_manifest(self, source, onlypy, mpy):
+        # returns {destination: (contents, binary)} and the .mpy destinations compiled from .py files
+        manifest = {}
+        for f in self.project_files(source, onlypy):
+            binary = f.endswith(".mpy")
+            destination, file_contents = self.upload_contents(f, binary, source)
+            manifest[destination] = (file_contents, binary)
+        if not mpy:
+            return manifest, []
+
+        mpycrossexe = mpycache.find_mpycross(self.mpycrossexe)
+        if mpycrossexe is None:
+            self.sres("mpy-cross not found, so uploading the .py files (set it with %mpy-cross --set-exe, "
+                      "or pip install mpy-cross)\n", 31)
+            return manifest, []
+        sources = {}
+        for destination in [d for d in manifest if mpycache.compilable(d)]:
+            if destination[:-3] + ".mpy" in manifest:
+                del manifest[destination]  # (a compiled copy in the project already, as with %sendfile)
+            else:
+                sources[destination] = manifest[destination][0]
+        results, errors = self.mpy_cache.compile_all(mpycrossexe, sources)
+        for destination, error in sorted(errors.items()):
+            self.sres("mpy-cross failed on '{}', uploading it as .py:\n{}\n".format(destination, error), 31)
+        for destination, mpy_bytes in results.items():
+            del manifest[destination]
+            manifest[destination[:-3] + ".mpy"] = (mpy_bytes, True)
+        return manifest, [destination[:-3] + ".mpy" for destination in results]
+
+    def shadowed_sources(self, compiled, device_paths):
+        # the .py files left on the device which would be imported ahead of the new .mpy of the same name
+        return [destination[:-4] + ".py" for destination in sorted(compiled) if destination[:-4] + ".py" in device_paths]
+
+    def upload_dir(self, source, onlypy, mpy=False, compress=False):
+        if not (os.path.exists(source) and os.path.isdir(source)):
             self.sres("'{0}' is not a directory\n\n".format(source))
+            return
+
+        manifest, compiled = self.project_manifest(source, onlypy, mpy)
+        device_paths = set()
+        if compiled:
+            if self.dc.device_tree.is_listed("", True):
+                device_paths = {entry.path for entry in self.dc.device_tree.listing("", True)}
+            else:
+                device_paths = {entry.path for entry in self.dc.device_walk("", True)}
+        self.dc.send_files([(destination, file_contents, binary)
+                            for destination, (file_contents, binary) in sorted(manifest.items())],
+                           mkdir=True, quiet=True, compress=compress)
+        for f in self.shadowed_sources(compiled, device_paths):
+            self.dc.remove_file(f)
+
+    def sync_dir(self, source, onlypy, delete, dryrun, mpy=False, compress=False):
+        # compare the project against sizes and hashes from the device got in one round trip
+        if not (os.path.exists(source) and os.path.isdir(source)):
+            self.sres("'{0}' is not a directory\n\n".format(source))
+            return
+
+        manifest, compiled = self.project_manifest(source, onlypy, mpy)
+        device_files = self.dc.device_file_hashes()
+        if device_files and all(h is None for size, h in device_files.values()):
+            self.sres("No hashlib on the device, so comparing all files as changed\n", 31)
+
+        uploads = []
+        for destination, (file_contents, binary) in sorted(manifest.items()):
+            contents_bytes = file_contents if binary else file_contents.encode("utf8")
+            device_file = device_files.get(destination)
+            if device_file is None:
+                uploads.append((destination, "new"))
+            elif device_file != (len(contents_bytes), hashlib.sha256(contents_bytes).hexdigest()):
+                uploads.append((destination, "changed"))
+
+        stale = self.shadowed_sources(compiled, device_files)
+        if delete:
+            stale += [f for f in sorted(device_files) if f not in manifest and f not in stale and
+                      (not onlypy or f.endswith('.py') or (mpy and f.endswith('.mpy')))]
+
+        self.sres("{} files unchanged, {} to upload, {} to delete\n".format(
+            len(manifest) - len(uploads), len(uploads), len(stale)))
+        if dryrun:
+            for destination, reason in uploads:
+                self.sres("  upload {} ({})\n".format(destination, reason))
+            for f in stale:
+                self.sres("  delete {}\n".format(f))
+            return
+
+        if uploads:
+            self.dc.send_files([(destination, manifest[destination][0], manifest[destination][1])
+                                for destination, reason in uploads], mkdir=True, quiet=True, compress=compress)
+        for f in stale:
+            self.dc.remove_file(f)
 
     def run_normal_cell(self, cell_contents, bsuppressendcode):
-        cmd_lines = cell_contents.splitlines(True)
-        r = self.dc.working_serial_readall()
-        if r:
-            self.sres('[priorstuff] ')
-            self.sres(str(r))
-
-        for line in cmd_lines:
-            if line:
-                if line[-2:] == '\r\n':
-                    line = line[:-2]
-                elif line[-1] == '\n':
-                    line = line[:-1]
-                self.dc.write_line(line)
-                r = self.dc.working_serial_readall()
-                if r:
-                    self.sres('[duringwriting] ')
-                    self.sres(str(r))
-
-        if not bsuppressendcode:
-            self.dc.write_bytes(b'\r\x04')
-            self.dc.receive_stream(seek_okay=True)
+        self.dc.run_cell(cell_contents, bsuppressendcode)
 
     def send_command(self, cell_contents):
         bsuppressendcode = False  # can't yet see how to get this signal through
@@ -630,6 +961,7 @@ class MicroPythonKernel(Kernel):
             self.srescapturedoutputfile.close()  # shouldn't normally get here
             self.sres("closing stuck open srescapturedoutputfile\n")
             self.srescapturedoutputfile = None
+        self.srestaillines = None
 
         # extract any %-commands we have here at the start (or ending?),
         # tolerating pure comment lines and white space before the first %
@@ -647,6 +979,11 @@ class MicroPythonKernel(Kernel):
             if cell_contents is None:
                 return None
 
+        if self.fleet.exists():
+            if cell_contents:
+                self.fleet.run_cell(cell_contents)
+            return None
+
         if not self.dc.serial_exists():
             self.sres("No serial connected\n", 31)
             self.sres("  %serialconnect to connect\n")
@@ -661,6 +998,7 @@ class MicroPythonKernel(Kernel):
 
     def sres_system(self, output, clear_output=False):  # system call
         self.sres(output, asciigraphicscode=34, clear_output=clear_output)
+        self.sres_flush()  # (these often come just before a wait, eg. for the serial port or the device broker)
 
     # 1=bold, 31=red, 32=green, 34=blue; from http://ascii-table.com/ansi-escape-sequences.php
     def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):
@@ -669,7 +1007,6 @@ class MicroPythonKernel(Kernel):
 
         if self.srescapturedoutputfile and (n04count == 0) and not asciigraphicscode:
             self.srescapturedoutputfile.write(output)
-            self.srescapturedlinecount += len(output.split("\n")) - 1
             if self.srescapturemode == 3:
                 # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
                 return
@@ -681,14 +1018,72 @@ class MicroPythonKernel(Kernel):
                     return
                 self.srescapturedlasttime = srescapturedtime
                 clear_output = True
-                output = "{} lines captured".format(self.srescapturedlinecount)
+                output = "{} lines captured".format(self.srescapturedoutputfile.lines_captured())
+
+        if self.srestaillines is not None and not clear_output:
+            self.sres_tail(output, asciigraphicscode or (31 if n04count != 0 else None))
+            return
 
         if clear_output:  # used when updating lines printed
+            self.sres_flush()
             self.send_response(self.iopub_socket, 'clear_output', {"wait": True})
         if asciigraphicscode:
             output = "\x1b[{}m{}\x1b[0m".format(asciigraphicscode, output)
-        stream_content = {'name': ("stdout" if n04count == 0 else "stderr"), 'text': output}
-        self.send_response(self.iopub_socket, 'stream', stream_content)
+
+        # consecutive output to the same stream goes out together (sres("") just lets out what is due)
+        stream_name = ("stdout" if n04count == 0 else "stderr")
+        if output:
+            if stream_name != self.srespendingname:
+                self.sres_flush()
+                self.srespendingname = stream_name
+            if not self.srespending:
+                self.srespendingtime = time.time()
+            self.srespending.append(output)
+            self.srespendingbytes += len(output)
+        if self.srespending and (clear_output or self.srespendingbytes >= sresFlushBytes or
+                                 time.time() - self.srespendingtime >= sresFlushInterval):
+            self.sres_flush()
+
+    def sres_tail(self, output, asciigraphicscode):
+        # everything goes into the ring of lines (stderr in red), as each redraw clears the whole cell output
+        pieces = output.split("\n")
+        for i, piece in enumerate(pieces):
+            if asciigraphicscode and piece:
+                piece = "\x1b[{}m{}\x1b[0m".format(asciigraphicscode, piece)
+            self.srestailpartial += piece
+            if i != len(pieces) - 1:
+                self.srestaillines.append(self.srestailpartial)
+                self.srestailpartial = ""
+                self.srestailcount += 1
+        if output:
+            self.srestaildirty = True
+        if self.srestaildirty and time.time() >= self.srestaillast + 1 / self.srestailfps:
+            self.sres_tail_draw()
+
+    def sres_tail_draw(self):
+        self.srestaillast = time.time()
+        self.srestaildirty = False
+        lines = list(self.srestaillines)
+        if self.srestailpartial:
+            lines.append(self.srestailpartial)
+        dropped = self.srestailcount - len(self.srestaillines)
+        summary = "\x1b[34m[{} lines, {} dropped]\x1b[0m\n".format(self.srestailcount, dropped)
+        self.sres_flush()
+        self.send_response(self.iopub_socket, 'clear_output', {"wait": True})
+        self.send_response(self.iopub_socket, 'stream', {'name': "stdout", 'text': "\n".join(lines + [summary])})
+
+    def sres_flush(self):
+        if self.srespending:
+            stream_content = {'name': self.srespendingname, 'text': "".join(self.srespending)}
+            self.srespending = []
+            self.srespendingbytes = 0
+            self.send_response(self.iopub_socket, 'stream', stream_content)
+
+    def do_complete(self, code, cursor_pos):
+        return self.symbol_index.complete(code, cursor_pos)
+
+    def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        return self.symbol_index.inspect(code, cursor_pos)
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         self.silent = silent
@@ -712,7 +1107,10 @@ class MicroPythonKernel(Kernel):
                 self.sres("You may need to reconnect")
                 self.dc.disconnect(raw=True, verbose=True)
 
-            except websocket.WebSocketConnectionClosedException as e:
+            except Exception as e:
+                import websocket  # only for WebSocketConnectionClosedException (and already loaded if connected)
+                if not isinstance(e, websocket.WebSocketConnectionClosedException):
+                    raise
                 prior_buffer = []
                 self.sres("\n\n***Websocket connection broken [%s]\n" % str(e), 31)
                 self.sres("You may need to reconnect")
@@ -734,6 +1132,11 @@ class MicroPythonKernel(Kernel):
                         self.sres('\n')
 
         set_next_input_payload = None
+        trace = self.dc.trace
+        if trace is not None and not re.match("\s*%profile", code):
+            trace.start_cell(code)
+        if self.dc.recorder is not None:
+            self.dc.recorder.cell(code)
         try:
             if not interrupted:
                 set_next_input_payload = self.send_command(code)
@@ -744,20 +1147,26 @@ class MicroPythonKernel(Kernel):
         # except pexpect.EOF:
         #    self.sres(self.asyncmodule.before + 'Restarting Bash')
         #    self.startasyncmodule()
+        if trace is not None:
+            trace.end_cell()
+        self.symbol_index.mark_stale()
+        self.sres_flush()
 
         if self.srescapturedoutputfile:
+            self.srescapturedoutputfile.close()
             if self.srescapturemode == 2:
                 self.send_response(self.iopub_socket, 'clear_output', {"wait": True})
-            if self.srescapturemode == 2 or self.srescapturemode == 3:
-                output = "{} lines captured.".format(
-                    self.srescapturedlinecount)  # finish off by updating with the correct number captured
-                stream_content = {'name': "stdout", 'text': output}
-                self.send_response(self.iopub_socket, 'stream', stream_content)
-
-            self.srescapturedoutputfile.close()
+            # finish off by updating with the correct number captured (and how fast)
+            output = "{}.\n".format(self.srescapturedoutputfile.stats())
+            stream_content = {'name': "stdout", 'text': output}
+            self.send_response(self.iopub_socket, 'stream', stream_content)
             self.srescapturedoutputfile = None
             self.srescapturemode = 0
 
+        if self.srestaillines is not None:
+            self.sres_tail_draw()  # final state, with the total line count
+            self.srestaillines = None
+
         if interrupted:
             self.sres_system("\n\n*** Sending Ctrl-C\n\n")
             if self.dc.serial_exists():
@@ -769,6 +1178,7 @@ class MicroPythonKernel(Kernel):
                     self.sres("\n\nKeyboard interrupt while waiting response on Ctrl-C\n\n")
                 except OSError as e:
                     self.sres("\n\n***OSError while issuing a Ctrl-C [%s]\n\n" % str(e.strerror))
+            self.sres_flush()
             return {'status': 'abort', 'execution_count': self.execution_count}
 
         # everything already gone out with send_response(), but could detect errors (text between the two \x04s
@@ -0,0 +1,102 @@
+import concurrent.futures
+import hashlib
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import time
+
+from .cache import DiskCache, default_cache_dir
+
+# bump this when the way mpy-cross is run below changes so old entries are not reused
+mpyCacheFormatVersion = b"1"
+mpyCacheMaxBytes = 64 * 1024 * 1024
+mpyCrossTimeout = 60
+mpyKeepSource = ("main.py", "boot.py")  # the device only runs these as .py
+
+
+def compilable(destination):
+    return destination.endswith(".py") and posixpath.basename(destination) not in mpyKeepSource
+
+
+def find_mpycross(mpycrossexe=None):
+    # the one set with %mpy-cross --set-exe, or else from the PATH (eg. pip install mpy-cross)
+    if mpycrossexe:
+        mpycrossexe = os.path.expanduser(mpycrossexe)
+        return mpycrossexe if os.path.isfile(mpycrossexe) else shutil.which(mpycrossexe)
+    return shutil.which("mpy-cross")
+
+
+# cross-compiles python source to .mpy bytecode for the device, many files at once on all the
+# cores, keeping the results on disk keyed by the sha256 of the source, its path on the device
+# (which goes into the .mpy for tracebacks) and the mpy-cross executable.
+class MpyCache:
+    def __init__(self, cache_dir=None, max_bytes=mpyCacheMaxBytes):
+        self.disk = DiskCache(cache_dir or default_cache_dir("mpy"), ".mpy", max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.0
+
+    def exe_key(self, mpycrossexe):
+        # a rebuilt or different mpy-cross could make different bytecode
+        st = os.stat(mpycrossexe)
+        return "{}\0{}\0{}".format(os.path.realpath(mpycrossexe), st.st_size, st.st_mtime_ns).encode("utf8")
+
+    def compile_one(self, mpycrossexe, destination, source_bytes, tempdir):
+        # returns (mpy bytes, None) or (None, error message)
+        infile = os.path.join(tempdir, hashlib.sha256(destination.encode("utf8")).hexdigest()[:16] + ".py")
+        outfile = infile[:-3] + ".mpy"
+        with open(infile, "wb") as f:
+            f.write(source_bytes)
+        try:
+            process = subprocess.run([mpycrossexe, "-o", outfile, "-s", destination, infile],
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=mpyCrossTimeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return None, str(e)
+        if process.returncode != 0 or not os.path.isfile(outfile):
+            return None, process.stdout.decode("utf8", "replace").strip() or \
+                "mpy-cross exited with {}".format(process.returncode)
+        with open(outfile, "rb") as f:
+            return f.read(), None
+
+    def compile_all(self, mpycrossexe, sources):
+        # sources is {destination: python source (str)}; returns {destination: mpy bytes} and {destination: error}
+        results, errors, pending = {}, {}, {}
+        exe_key = self.exe_key(mpycrossexe)
+        for destination, file_contents in sources.items():
+            source_bytes = file_contents.encode("utf8")
+            key_parts = [mpyCacheFormatVersion, exe_key, destination.encode("utf8"), source_bytes]
+            cached = self.disk.get(key_parts)
+            if cached is not None:
+                results[destination] = cached
+                self.hits += 1
+            else:
+                pending[destination] = (source_bytes, key_parts)
+        if not pending:
+            return results, errors
+
+        self.misses += len(pending)
+        start_time = time.monotonic()
+        # (threads are enough to keep every core busy, the compiling is in the mpy-cross processes)
+        with tempfile.TemporaryDirectory(prefix="mpycross") as tempdir, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(self.compile_one, mpycrossexe, destination, source_bytes, tempdir): destination
+                       for destination, (source_bytes, key_parts) in pending.items()}
+            for future in concurrent.futures.as_completed(futures):
+                destination = futures[future]
+                mpy_bytes, error = future.result()
+                if error is not None:
+                    errors[destination] = error
+                else:
+                    results[destination] = mpy_bytes
+        self.compile_seconds += time.monotonic() - start_time
+
+        for destination, (source_bytes, key_parts) in pending.items():
+            if destination in results:
+                self.disk.put(key_parts, results[destination])
+        self.disk.evict()
+        return results, errors
+
+    def stats(self):
+        return "mpy-cross cache: {} hits, {} compiled in {:.2f}s".format(self.hits, self.misses, self.compile_seconds)
@@ -0,0 +1,40 @@
+from .cache import DiskCache, default_cache_dir
+
+# bump this when the conversion below changes so old entries are not reused
+cacheFormatVersion = b"1"
+cacheMaxBytes = 64 * 1024 * 1024
+
+
+# converts .ipynb files to the python source uploaded to the device, keeping the results on disk
+# keyed by the sha256 of the notebook so unchanged notebooks are not put through nbconvert again
+class NotebookCache:
+    def __init__(self, cache_dir=None, max_bytes=cacheMaxBytes):
+        self.disk = DiskCache(cache_dir or default_cache_dir("notebooks"), ".py", max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._py_exporter = None  # one exporter for the whole kernel session
+
+    def convert(self, source):
+        with open(source, "rb") as f:
+            notebook_bytes = f.read()
+        key_parts = [cacheFormatVersion, notebook_bytes]
+        cached = self.disk.get(key_parts)
+        if cached is not None:
+            self.hits += 1
+            return cached.decode("utf8")
+
+        self.misses += 1
+        import nbconvert  # (slow to import, so only when a notebook is actually converted)
+        import nbformat
+        if self._py_exporter is None:
+            self._py_exporter = nbconvert.PythonExporter()
+        notebook = nbformat.reads(notebook_bytes.decode("utf8"), as_version=4)
+        output, resources = self._py_exporter.from_notebook_node(notebook)
+        file_contents = output.replace("get_ipython().run_line_magic", "# %")
+
+        if self.disk.put(key_parts, file_contents.encode("utf8")):
+            self.disk.evict()
+        return file_contents
+
+    def stats(self):
+        return "notebook conversion cache: {} hits, {} misses".format(self.hits, self.misses)
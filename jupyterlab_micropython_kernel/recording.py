@@ -0,0 +1,281 @@
+import argparse
+import bisect
+import gzip
+import struct
+import sys
+import threading
+import time
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+# a session file holds every byte sent to and received from the device, with times, so that
+# traffic from the field can be replayed against the kernel's parsing offline.
+#   python -m jupyterlab_micropython_kernel.recording session.mpysession --replay
+# It is gzipped records of kind (1 byte), seconds since the start (double), length (uint32) and data
+sessionMagic = b"MPYSESSION 1\n"
+sessionRecordHeader = struct.Struct("<cdI")
+sessionSent = b"s"
+sessionReceived = b"r"
+sessionCell = b"m"  # the source of a cell, marking where it began
+sessionConnection = b"c"  # description of the connection
+
+
+class SessionRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fout = gzip.open(filename, "wb", compresslevel=6)
+        self.fout.write(sessionMagic)
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()  # (received bytes are recorded on the DeviceReader thread)
+        self.wrapped = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def record(self, kind, b):
+        with self.lock:
+            if self.fout is not None:
+                self.fout.write(sessionRecordHeader.pack(kind, time.monotonic() - self.start_time, len(b)))
+                self.fout.write(b)
+
+    def sent(self, b):
+        if type(b) == str:
+            b = b.encode("utf8")  # (the websocket takes strings too)
+        self.bytes_sent += len(b)
+        self.record(sessionSent, bytes(b))
+
+    def received(self, b):
+        self.bytes_received += len(b)
+        self.record(sessionReceived, b)
+
+    def cell(self, cell_contents):
+        self.record(sessionCell, cell_contents.encode("utf8"))
+
+    def wrap_write(self, conn, attr, description):
+        # the connection is written to from many places, so its own write function is replaced
+        write = getattr(conn, attr)
+
+        def recording_write(b, *args, **kwargs):
+            self.sent(b)
+            return write(b, *args, **kwargs)
+        setattr(conn, attr, recording_write)
+        self.wrapped.append((conn, attr))
+        self.record(sessionConnection, description.encode("utf8"))
+
+    def close(self):
+        for conn, attr in self.wrapped:
+            try:
+                delattr(conn, attr)  # (back to the method of its class)
+            except AttributeError:
+                pass
+        self.wrapped = []
+        with self.lock:
+            if self.fout is not None:
+                self.fout.close()
+                self.fout = None
+
+    def stats(self):
+        return "{} bytes sent and {} received in {:.1f}s".format(self.bytes_sent, self.bytes_received,
+                                                                 time.monotonic() - self.start_time)
+
+
+def read_session(filename):
+    # yields (kind, seconds, data)
+    with gzip.open(filename, "rb") as fin:
+        if fin.read(len(sessionMagic)) != sessionMagic:
+            raise ValueError("{} is not a session recording".format(filename))
+        while True:
+            header = fin.read(sessionRecordHeader.size)
+            if len(header) < sessionRecordHeader.size:
+                break  # (a recording cut off by the kernel dying is still good up to here)
+            kind, t, n = sessionRecordHeader.unpack(header)
+            data = fin.read(n)
+            if len(data) < n:
+                break
+            yield kind, t, data
+
+
+# plays the device's side of a recording in lockstep with what is written to it: received bytes are
+# let out once as many bytes have been written as had been sent before them, and (unless fast)
+# no sooner after that than they came in the recording.  Looks like a serial port to DeviceConnector.
+class ReplaySerial(SerialBase):
+    def __init__(self, filename, fast=False, **kwargs):
+        self.filename = filename
+        self.fast = fast
+        self.events = []  # (sent bytes before it, time of the last of those sends, time, data)
+        self.cells = []  # (sent bytes before it, index into events, time, source)
+        self.sent_stream = bytearray()
+        self.duration = 0.0
+        self.condition = threading.Condition()
+        super(ReplaySerial, self).__init__(port=filename, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        try:
+            records = list(read_session(self.filename))
+        except (OSError, ValueError) as e:
+            raise SerialException(str(e))
+        last_sent_time = 0.0
+        for kind, t, data in records:
+            if kind == sessionSent:
+                self.sent_stream.extend(data)
+                last_sent_time = t
+            elif kind == sessionReceived:
+                self.events.append((len(self.sent_stream), last_sent_time, t, data))
+            elif kind == sessionCell:
+                self.cells.append((len(self.sent_stream), len(self.events), t, data.decode("utf8", "replace")))
+            self.duration = t
+        self.raw_paste = b"\x05A\x01" in self.sent_stream  # (so the replay takes the same route)
+        self.seek_cell(None)
+        self.is_open = True
+
+    def seek_cell(self, k):
+        # start the replay at the kth cell, as though everything sent before it had been (None for the beginning)
+        with self.condition:
+            self.base_sent, self.event_index, self.base_time = (self.cells[k][:3] if k is not None else (0, 0, 0.0))
+            self.written = 0
+            self.write_counts = [self.base_sent]
+            self.write_times = [time.monotonic()]
+            self.released = bytearray()
+            self.mismatch_count = 0
+            self.first_mismatch = None
+            self.condition.notify_all()
+
+    def release_time(self):
+        # when the next event is due, or None if it waits on more being written
+        sent_before, sent_time, t, data = self.events[self.event_index]
+        j = bisect.bisect_left(self.write_counts, sent_before)
+        if j == len(self.write_counts):
+            return None
+        if self.fast:
+            return 0
+        # (as long after the write that let it out as it came after that send in the recording)
+        return self.write_times[j] + max(0.0, t - (sent_time if sent_before > self.base_sent else self.base_time))
+
+    def release_due(self):
+        now = time.monotonic()
+        while self.event_index < len(self.events):
+            t = self.release_time()
+            if t is None or t > now:
+                return t
+            self.released.extend(self.events[self.event_index][3])
+            self.event_index += 1
+        return None
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        with self.condition:
+            self.release_due()
+            return len(self.released)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        end_time = time.monotonic() + (self._timeout if self._timeout is not None else 1e9)
+        with self.condition:
+            while True:
+                due = self.release_due()
+                if self.released or not self.is_open:
+                    break
+                now = time.monotonic()
+                if now >= end_time:
+                    break
+                self.condition.wait(min(end_time, due if due is not None else end_time) - now)
+            res = bytes(self.released[:size])
+            del self.released[:size]
+            return res
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = bytes(data)
+        with self.condition:
+            i = self.base_sent + self.written
+            if self.sent_stream[i:i + len(data)] != data:
+                self.mismatch_count += 1
+                if self.first_mismatch is None:
+                    self.first_mismatch = (i, data[:40], bytes(self.sent_stream[i:i + 40]))
+            self.written += len(data)
+            self.write_counts.append(self.base_sent + self.written)
+            self.write_times.append(time.monotonic())
+            self.condition.notify_all()
+        return len(data)
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.released.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def _reconfigure_port(self):
+        pass  # (no settings to a recording)
+
+    def _update_break_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    def stats(self):
+        res = "{} of {} recorded replies played".format(self.event_index, len(self.events))
+        if self.first_mismatch is not None:
+            i, written, recorded = self.first_mismatch
+            res += ", {} writes differed from the recording (first at byte {}: {} where it had {})".format(
+                self.mismatch_count, i, repr(written), repr(recorded))
+        return res
+
+
+def main():
+    from . import deviceconnector
+
+    ap = argparse.ArgumentParser(prog="jupyterlab_micropython_kernel.recording",
+                                 description="summarise or replay a session recorded with %record")
+    ap.add_argument('filename', type=str)
+    ap.add_argument('--replay', action='store_true',
+                    help='run the recorded cells back through the kernel\'s parsing (cells of %%commands are skipped)')
+    ap.add_argument('--fast', action='store_true', help='replay without the recorded delays')
+    ap.add_argument('--dump', action='store_true', help='print every record')
+    args = ap.parse_args()
+
+    if args.dump:
+        for kind, t, data in read_session(args.filename):
+            print("{:10.4f} {} {}".format(t, kind.decode(), repr(data)))
+
+    def sres(output, asciigraphicscode=None, n04count=0, clear_output=False):
+        sys.stdout.write(output)
+
+    dc = deviceconnector.DeviceConnector(sres, sres)
+    dc.replay_connect(args.filename, args.fast)
+    replay = dc.working_serial
+    if replay is None:
+        return
+    print("{:.1f}s, {} bytes sent, {} bytes received in {} replies, {} cells".format(
+        replay.duration, len(replay.sent_stream), sum(len(event[3]) for event in replay.events),
+        len(replay.events), len(replay.cells)))
+    if args.replay:
+        for k, (sent_before, event_index, t, cell_contents) in enumerate(replay.cells):
+            print("\n\n[cell {}] {}".format(k, cell_contents.strip().splitlines()[0] if cell_contents.strip() else ""))
+            if cell_contents.lstrip().startswith("%"):
+                continue
+            replay.seek_cell(k)
+            dc.working_serial_chunk = None
+            dc.working_reader.take()
+            start_time = time.monotonic()
+            dc.run_cell(cell_contents)
+            print("\n[{:.3f}s; {}]".format(time.monotonic() - start_time, replay.stats()))
+    dc.disconnect(raw=True)
+
+
+if __name__ == "__main__":
+    main()
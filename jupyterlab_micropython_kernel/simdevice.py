@@ -0,0 +1,484 @@
+import argparse
+import base64
+import binascii
+import gc
+import hashlib
+import os
+import posixpath
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import types
+import zlib
+
+# a simulated MicroPython device, for measuring the kernel without hardware.  Programs are run by
+# CPython with small stand-ins for the MicroPython modules, and the files live in a local directory.
+# It talks over a pty (like a serial port), a TCP socket or a websocket (like the WebREPL).
+#   python -m jupyterlab_micropython_kernel.simdevice --transport pty --baud 115200 ROOTDIR
+
+simDeviceBanner = b'MicroPython v1.22.0 on simdevice; CPython\r\nType "help()" for more information.\r\n>>> '
+simRawReplBanner = b"raw REPL; CTRL-B to exit\r\n>"
+simWebreplPassword = "micropython"
+webreplRequest = struct.Struct("<2sBBQLH64s")  # the WebREPL's file transfer request, as the kernel sends it
+webreplPutFile = 1
+webreplGetFile = 2
+
+
+class SimDeviceReset(Exception):
+    pass
+
+
+# the decompressing side of MicroPython's deflate.DeflateIO
+class SimDeflateIO:
+    def __init__(self, stream, format=0, wbits=0):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj({1: -15, 2: 15, 3: 31}.get(format, 47))
+        self.pending = b""
+
+    def read(self, n=-1):
+        while (n < 0 or len(self.pending) < n) and not self.decompressor.eof:
+            data = self.stream.read(256)
+            if not data:
+                break
+            self.pending += self.decompressor.decompress(data)
+        res, self.pending = (self.pending, b"") if n < 0 else (self.pending[:n], self.pending[n:])
+        return res
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.stream.close()
+
+
+class SimDevice:
+    def __init__(self, root, baudrate=0, latency=0.0, raw_paste=True, raw_paste_window=128, start_raw=False,
+                 missing_modules=()):
+        self.root = os.path.abspath(root)
+        self.missing_modules = missing_modules  # eg. ("deflate",) for firmware older than 1.21
+        self.baudrate = baudrate  # 0 for unthrottled
+        self.latency = latency  # seconds added to every execution
+        self.raw_paste = raw_paste
+        self.raw_paste_window = raw_paste_window
+        self.mode = "raw" if start_raw else "normal"
+        self.cwd = "/"
+        self.globals = {}
+        self.inbuf = bytearray()
+        self.condition = threading.Condition()
+        self.output = None  # function sending bytes to the host, set by the transport
+
+    def start(self):
+        threading.Thread(target=self.run_repl, daemon=True).start()
+
+    # host side, called by the transport
+    def feed(self, b):
+        if self.baudrate:
+            time.sleep(len(b) * 10 / self.baudrate)
+        with self.condition:
+            self.inbuf.extend(b)
+            self.condition.notify_all()
+
+    # device side
+    def send(self, b):
+        if self.baudrate:
+            time.sleep(len(b) * 10 / self.baudrate)
+        if self.output is not None:
+            self.output(b)
+
+    def getc(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.inbuf)
+            c = self.inbuf[0]
+            del self.inbuf[0]
+            return c
+
+    def read(self, n):
+        return bytes(self.getc() for i in range(n))
+
+    def soft_reboot(self, message=b"MPY: soft reboot\r\n"):
+        self.globals = {}
+        self.cwd = "/"
+        self.mode = "normal"
+        self.send(message + simDeviceBanner)
+
+    def run_repl(self):
+        line = bytearray()
+        while True:
+            c = self.getc()
+            if self.mode == "normal":
+                if c == 3:  # ctrl-C
+                    line.clear()
+                    self.send(b"\r\n>>> ")
+                elif c == 1:  # ctrl-A
+                    self.mode = "raw"
+                    line.clear()
+                    self.send(b"\r\n" + simRawReplBanner)
+                elif c == 4:  # ctrl-D
+                    self.soft_reboot()
+                elif c == 13:
+                    if line.strip():
+                        self.send(b"\r\n")
+                        self.execute(bytes(line))
+                    line.clear()
+                    self.send(b"\r\n>>> ")
+                elif c != 10 and c != 2:
+                    line.append(c)
+                    self.send(bytes([c]))
+                continue
+
+            if c == 2:  # ctrl-B
+                self.mode = "normal"
+                line.clear()
+                self.send(b"\r\n" + simDeviceBanner)
+            elif c == 1:
+                line.clear()
+                self.send(simRawReplBanner)
+            elif c == 3:
+                line.clear()
+            elif c == 5 and self.raw_paste and line == b"":
+                line.extend(self.read(2))  # A, ctrl-A
+                self.send(b"R\x01" + struct.pack("<H", self.raw_paste_window))
+                program = bytearray()
+                window_remain = self.raw_paste_window
+                while True:
+                    x = self.getc()
+                    if x == 4:
+                        break
+                    program.append(x)
+                    window_remain -= 1
+                    if window_remain == 0:
+                        window_remain = self.raw_paste_window
+                        self.send(b"\x01")
+                line.clear()
+                self.send(b"\x04")
+                self.execute_raw(bytes(program))
+            elif c == 4:
+                self.send(b"OK")
+                program = bytes(line)
+                line.clear()
+                self.execute_raw(program)
+            else:
+                line.append(c)
+
+    def execute_raw(self, program):
+        try:
+            error = self.execute(program)
+        except SimDeviceReset:
+            return
+        self.send(b"\x04" + error + b"\x04>")
+
+    def host_path(self, path):
+        device_path = posixpath.normpath(posixpath.join(self.cwd, path or "."))
+        return os.path.join(self.root, device_path.lstrip("/"))
+
+    def device_modules(self):
+        device = self
+
+        class Stdout:
+            def write(self, s):
+                if isinstance(s, str):
+                    s = s.encode("utf8")
+                device.send(bytes(s).replace(b"\n", b"\r\n"))
+                return len(s)
+
+            class buffer:
+                @staticmethod
+                def write(b):
+                    device.send(bytes(b))
+                    return len(b)
+
+        class Stdin:
+            class buffer:
+                @staticmethod
+                def read(n):
+                    return device.read(n)
+
+        def ilistdir(path=""):
+            for entry in os.scandir(device.host_path(path)):
+                yield (entry.name, (0x4000 if entry.is_dir() else 0x8000), 0, entry.stat().st_size)
+
+        def chdir(path):
+            if not os.path.isdir(device.host_path(path)):
+                raise OSError(2, "ENOENT")
+            device.cwd = posixpath.normpath(posixpath.join(device.cwd, path))
+
+        def mem_info():
+            Stdout().write("stack: 736 out of 15360\nGC: total: 111168, used: 8048, free: 103120\n")
+
+        def reset():
+            device.soft_reboot(message=b"\r\n")
+            raise SimDeviceReset()
+
+        mod_sys = types.ModuleType("sys")
+        mod_sys.stdout = Stdout()
+        mod_sys.stdin = Stdin()
+        mod_sys.implementation = types.SimpleNamespace(name="micropython", version=(1, 22, 0))
+        mod_sys.platform = "simdevice"
+        mod_os = types.ModuleType("os")
+        mod_os.ilistdir = ilistdir
+        mod_os.listdir = lambda path="": sorted(os.listdir(device.host_path(path)))
+        mod_os.chdir = chdir
+        mod_os.getcwd = lambda: device.cwd
+        for name in ("mkdir", "remove", "rmdir", "stat"):
+            setattr(mod_os, name, (lambda f: lambda path, *args: f(device.host_path(path), *args))(getattr(os, name)))
+        mod_os.rename = lambda a, b: os.rename(device.host_path(a), device.host_path(b))
+        mod_micropython = types.ModuleType("micropython")
+        mod_micropython.kbd_intr = lambda c: None
+        mod_micropython.mem_info = mem_info
+        mod_machine = types.ModuleType("machine")
+        mod_machine.reset = reset
+        mod_time = types.ModuleType("time")
+        mod_time.__dict__.update(vars(time))
+        mod_time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+        mod_time.sleep_us = lambda us: time.sleep(us / 1000000)
+        mod_time.ticks_ms = lambda: int(time.monotonic() * 1000) & 0x3fffffff
+        mod_time.ticks_us = lambda: int(time.monotonic() * 1000000) & 0x3fffffff
+        mod_time.ticks_diff = lambda a, b: ((a - b + 0x20000000) & 0x3fffffff) - 0x20000000
+        mod_deflate = types.ModuleType("deflate")
+        mod_deflate.__dict__.update(RAW=1, ZLIB=2, GZIP=3, AUTO=0, DeflateIO=SimDeflateIO)
+        modules = {"sys": mod_sys, "os": mod_os, "micropython": mod_micropython, "machine": mod_machine,
+                   "binascii": binascii, "hashlib": hashlib, "zlib": zlib, "gc": gc, "time": mod_time, "struct": struct,
+                   "deflate": mod_deflate}
+        modules.update({"u" + name: module for name, module in list(modules.items())})
+        for name in self.missing_modules:
+            modules.pop(name, None)
+            modules.pop("u" + name, None)
+        return modules, Stdout()
+
+    def execute(self, program):
+        # returns the text of any exception, for between the \x04s
+        if self.latency:
+            time.sleep(self.latency)
+        modules, stdout = self.device_modules()
+        real_import = __import__
+
+        def device_import(name, *args, **kwargs):
+            return modules[name] if name in modules else real_import(name, *args, **kwargs)
+
+        def device_open(path, mode="r", *args, **kwargs):
+            return open(self.host_path(path), mode, *args, **kwargs)
+
+        def device_print(*args, sep=" ", end="\n", file=None):
+            (file or stdout).write(sep.join(map(str, args)) + end)
+
+        device_builtins = dict(vars(__builtins__) if not isinstance(__builtins__, dict) else __builtins__)
+        device_builtins.update(__import__=device_import, open=device_open, print=device_print)
+        self.globals["__builtins__"] = device_builtins
+        try:
+            exec(compile(program.decode("utf8"), "<stdin>", "exec"), self.globals)
+        except SimDeviceReset:
+            raise
+        except BaseException as e:
+            stack = [frame for frame in traceback.extract_tb(e.__traceback__) if frame.filename == "<stdin>"]
+            lines = ["Traceback (most recent call last):"]
+            lines.extend('  File "<stdin>", line {}, in {}'.format(frame.lineno, frame.name) for frame in stack)
+            lines.append("{}: {}".format(type(e).__name__, e))
+            return ("\r\n".join(lines) + "\r\n").encode("utf8")
+        return b""
+
+
+def make_pty(device):
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+
+    def reader():
+        while True:
+            try:
+                b = os.read(master, 4096)
+            except OSError:
+                time.sleep(0.01)  # (no one has the port open)
+                continue
+            device.feed(b)
+    device.output = lambda b: os.write(master, b)
+    threading.Thread(target=reader, daemon=True).start()
+    return os.ttyname(slave)
+
+
+def make_tcp_server(device, port=0):
+    # like %socketconnect expects, straight into the raw REPL
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+
+    def serve():
+        while True:
+            client, addr = server.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            device.mode = "raw"
+            device.output = client.sendall
+            try:
+                while True:
+                    b = client.recv(4096)
+                    if not b:
+                        break
+                    device.feed(b)
+            except OSError:
+                pass
+            device.output = None
+            client.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def websocket_frame(b, binary=False):
+    # text frames, unless they would not decode
+    opcode = 0x82 if binary or any(c >= 0x80 for c in b) else 0x81
+    if len(b) < 126:
+        header = struct.pack("!BB", opcode, len(b))
+    elif len(b) < 65536:
+        header = struct.pack("!BBH", opcode, 126, len(b))
+    else:
+        header = struct.pack("!BBQ", opcode, 127, len(b))
+    return header + b
+
+
+def read_websocket_frame(f):
+    # returns (opcode, payload) of a frame from the client (which are always masked)
+    b0, b1 = f.read(2)
+    n = b1 & 0x7f
+    if n == 126:
+        n = struct.unpack("!H", f.read(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q", f.read(8))[0]
+    mask = f.read(4) if b1 & 0x80 else b"\0\0\0\0"
+    payload = f.read(n)
+    return b0 & 0x0f, bytes(c ^ mask[i % 4] for i, c in enumerate(payload))
+
+
+def serve_webrepl_file(device, request, f, client):
+    # the WebREPL's own file transfers (as in webrepl.py), over binary frames and not through the REPL
+    sig, kind, reserved, offset, size, fnlen, fname = webreplRequest.unpack(request)
+    path = device.host_path(fname[:fnlen].decode("utf8"))
+
+    def respond(code):
+        client.sendall(websocket_frame(struct.pack("<2sH", b"WB", code), binary=True))
+
+    def throttle(n):
+        if device.baudrate:
+            time.sleep(n * 10 / device.baudrate)
+
+    if kind == webreplPutFile:
+        try:
+            out = open(path, "wb")
+        except OSError:
+            respond(1)
+            return
+        respond(0)
+        remaining = size
+        with out:
+            while remaining > 0:
+                opcode, payload = read_websocket_frame(f)
+                throttle(len(payload))
+                out.write(payload[:remaining])
+                remaining -= len(payload)
+        respond(0)
+    elif kind == webreplGetFile:
+        try:
+            src = open(path, "rb")
+        except OSError:
+            respond(1)
+            return
+        respond(0)
+        with src:
+            while True:
+                read_websocket_frame(f)  # (the client asks for each block)
+                block = src.read(1024)
+                throttle(len(block) + 2)
+                client.sendall(websocket_frame(struct.pack("<H", len(block)), binary=True))
+                if not block:
+                    break
+                client.sendall(websocket_frame(block, binary=True))
+        respond(0)
+    else:
+        respond(1)
+
+
+def make_websocket_server(device, port=0, password=simWebreplPassword, webrepl_files=True):
+    # like the WebREPL, asking for the password first
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", port))
+    server.listen(1)
+
+    def serve_client(client):
+        f = client.makefile("rb")
+        key = None
+        for line in iter(f.readline, b"\r\n"):
+            if line.lower().startswith(b"sec-websocket-key:"):
+                key = line.split(b":", 1)[1].strip()
+        accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+        client.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                       b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+        client.sendall(websocket_frame(b"Password: "))
+        entered = b""
+        while not entered.endswith(b"\r\n") and not entered.endswith(b"\r"):
+            opcode, payload = read_websocket_frame(f)
+            if opcode == 8:
+                return
+            entered += payload
+        if entered.strip().decode("utf8", "replace") != password:
+            client.sendall(websocket_frame(b"\r\nAccess denied\r\n"))
+            return
+        device.output = lambda b: client.sendall(websocket_frame(b))
+        client.sendall(websocket_frame(b"\r\nWebREPL connected\r\n>>> "))
+        while True:
+            opcode, payload = read_websocket_frame(f)
+            if opcode == 8:
+                break
+            if webrepl_files and opcode == 2 and len(payload) == webreplRequest.size and payload[:2] == b"WA":
+                serve_webrepl_file(device, payload, f, client)
+                continue
+            device.feed(payload)
+
+    def serve():
+        while True:
+            client, addr = server.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                serve_client(client)
+            except (OSError, ValueError):
+                pass
+            device.output = None
+            client.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="jupyterlab_micropython_kernel.simdevice",
+                                 description="a simulated MicroPython device with its files in rootdir")
+    ap.add_argument('rootdir', type=str)
+    ap.add_argument('--transport', choices=['pty', 'tcp', 'websocket'], default='pty')
+    ap.add_argument('--port', type=int, default=0, help='for tcp and websocket')
+    ap.add_argument('--baud', type=int, default=0, help='throttle to this baudrate (default unthrottled)')
+    ap.add_argument('--latency', type=float, default=0.0, help='seconds added to every execution')
+    ap.add_argument('--noraw_paste', action='store_true', help='behave like firmware older than raw paste mode')
+    args = ap.parse_args()
+    device = SimDevice(args.rootdir, args.baud, args.latency, raw_paste=not args.noraw_paste)
+    if args.transport == "pty":
+        print("%serialconnect --port={}".format(make_pty(device)))
+    elif args.transport == "tcp":
+        print("%socketconnect 127.0.0.1 {}".format(make_tcp_server(device, args.port)))
+    else:
+        print("%websocketconnect ws://127.0.0.1:{} --password {}"
+              .format(make_websocket_server(device, args.port), simWebreplPassword))
+    sys.stdout.flush()
+    device.start()
+    try:
+        while True:
+            time.sleep(100)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
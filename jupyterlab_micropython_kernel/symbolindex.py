@@ -0,0 +1,213 @@
+import collections
+import keyword
+import re
+import time
+
+# completion and inspection from names got from the device, so that a keystroke does not wait on it.
+# The globals come in one execution, again only after a cell has run, along with the members of any
+# modules among them not already known.  Members of modules are kept until the device is rebooted
+# (or symbolIndexTTL), and those of other objects are asked for once and kept until the next cell.
+symbolIndexTTL = 600.0
+symbolIndexMaxObjects = 64  # objects whose members are kept, the least recently used dropped beyond this
+
+# prints a tab separated line of object, name and type name for each name (except the __ ones and the
+# kernel's helpers) in the globals (n == '')
+# or in the object named n, and unless m is None the same for each module found which is not in m.
+# Nothing the user wrote is evaluated, and no property or __getattr__ of an object is run: the dotted
+# name is followed one getattr at a time (along names already listed), and the members of anything
+# but a module are looked up on its class, with its own __dict__ on top
+deviceSymbolLister = """def O_syms(n, m):
+  g = globals()
+  d = g
+  if n:
+    p = n.split('.')
+    o = g[p[0]]
+    for k in p[1:]:
+      o = getattr(o, k)
+    if type(o).__name__ == 'module':
+      d = o.__dict__
+    else:
+      c = o if isinstance(o, type) else type(o)
+      d = {}
+      for k in dir(c):
+        try:
+          d[k] = getattr(c, k)
+        except Exception:
+          pass
+      if c is not o:
+        try:
+          d.update(o.__dict__)
+        except Exception:
+          pass
+  for k in d:
+    if k[:2] in ('O_', '__'):
+      continue
+    t = type(d[k]).__name__
+    print(n + '\\t' + k + '\\t' + t)
+    if m is not None and t == 'module' and k not in m:
+      O_syms(k, None)
+"""
+
+# for when the device can't be asked (not connected, or in the middle of printing something)
+staticBuiltins = [
+    "abs", "all", "any", "bin", "bool", "bytearray", "bytes", "callable", "chr", "classmethod", "compile", "complex",
+    "delattr", "dict", "dir", "divmod", "enumerate", "eval", "exec", "filter", "float", "frozenset", "getattr",
+    "globals", "hasattr", "hash", "help", "hex", "id", "input", "int", "isinstance", "issubclass", "iter", "len",
+    "list", "locals", "map", "max", "memoryview", "min", "next", "object", "oct", "open", "ord", "pow", "print",
+    "property", "range", "repr", "reversed", "round", "set", "setattr", "slice", "sorted", "staticmethod", "str",
+    "sum", "super", "tuple", "type", "zip", "Exception", "ValueError", "TypeError", "OSError", "KeyError",
+    "IndexError", "RuntimeError", "KeyboardInterrupt", "StopIteration", "AttributeError", "ImportError",
+    "NotImplementedError", "MemoryError", "ZeroDivisionError"]
+staticModules = {
+    "machine": ["ADC", "I2C", "PWM", "Pin", "RTC", "SPI", "SoftI2C", "SoftSPI", "Timer", "UART", "WDT", "deepsleep",
+                "disable_irq", "enable_irq", "freq", "idle", "lightsleep", "mem8", "mem16", "mem32", "reset",
+                "reset_cause", "soft_reset", "time_pulse_us", "unique_id"],
+    "time": ["gmtime", "localtime", "mktime", "sleep", "sleep_ms", "sleep_us", "ticks_add", "ticks_cpu",
+             "ticks_diff", "ticks_ms", "ticks_us", "time", "time_ns"],
+    "os": ["VfsFat", "VfsLfs2", "chdir", "dupterm", "getcwd", "ilistdir", "listdir", "mkdir", "mount", "remove",
+           "rename", "rmdir", "stat", "statvfs", "sync", "umount", "uname", "urandom"],
+    "sys": ["argv", "byteorder", "exit", "implementation", "maxsize", "modules", "path", "platform",
+            "print_exception", "stderr", "stdin", "stdout", "version", "version_info"],
+    "gc": ["collect", "disable", "enable", "isenabled", "mem_alloc", "mem_free", "threshold"],
+    "micropython": ["alloc_emergency_exception_buf", "const", "heap_lock", "heap_unlock", "kbd_intr", "mem_info",
+                    "opt_level", "qstr_info", "schedule", "stack_use"],
+    "network": ["AP_IF", "STA_IF", "WLAN", "country", "hostname"],
+    "asyncio": ["Event", "Lock", "ThreadSafeFlag", "create_task", "gather", "get_event_loop", "new_event_loop",
+                "open_connection", "run", "sleep", "sleep_ms", "start_server", "wait_for"],
+    "json": ["dump", "dumps", "load", "loads"],
+    "struct": ["calcsize", "pack", "pack_into", "unpack", "unpack_from"],
+    "binascii": ["a2b_base64", "b2a_base64", "crc32", "hexlify", "unhexlify"],
+    "hashlib": ["md5", "sha1", "sha256"],
+    "random": ["choice", "getrandbits", "randint", "random", "randrange", "seed", "uniform"],
+    "math": ["acos", "asin", "atan", "atan2", "ceil", "cos", "degrees", "e", "exp", "fabs", "floor", "fmod", "inf",
+             "isfinite", "isinf", "isnan", "log", "modf", "nan", "pi", "pow", "radians", "sin", "sqrt", "tan",
+             "trunc"],
+    "socket": ["AF_INET", "SOCK_DGRAM", "SOCK_STREAM", "SOL_SOCKET", "SO_REUSEADDR", "getaddrinfo", "socket"],
+    "select": ["POLLERR", "POLLHUP", "POLLIN", "POLLOUT", "poll", "select"],
+    "neopixel": ["NeoPixel"],
+    "dht": ["DHT11", "DHT22"],
+    "onewire": ["OneWire"],
+    "ds18x20": ["DS18X20"],
+    "framebuf": ["FrameBuffer", "GS2_HMSB", "GS4_HMSB", "GS8", "MONO_HLSB", "MONO_HMSB", "MONO_VLSB", "RGB565"],
+    "bluetooth": ["BLE", "FLAG_NOTIFY", "FLAG_READ", "FLAG_WRITE", "UUID"],
+    "esp": ["flash_erase", "flash_read", "flash_size", "flash_user_start", "flash_write", "osdebug",
+            "sleep_type"],
+    "esp32": ["NVS", "Partition", "RMT", "ULP", "raw_temperature", "wake_on_ext0", "wake_on_ext1",
+              "wake_on_touch"],
+    "_thread": ["allocate_lock", "exit", "get_ident", "stack_size", "start_new_thread"],
+    "array": ["array"],
+    "collections": ["OrderedDict", "deque", "namedtuple"],
+    "errno": ["EAGAIN", "EEXIST", "EINVAL", "EIO", "ENOENT", "ENOMEM", "ETIMEDOUT", "errorcode"],
+    "io": ["BytesIO", "StringIO", "open"],
+    "re": ["compile", "match", "search", "sub"],
+}
+
+completionToken = re.compile(r"([A-Za-z_][\w]*(?:\.[A-Za-z_]\w*)*\.?)?$")
+importLine = re.compile(r"^\s*(?:import|from)\s+[\w.]*$")
+objectExpression = re.compile(r"^[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*$")  # (nothing with side effects goes to eval)
+
+
+class SymbolIndex:
+    def __init__(self, dc):
+        self.dc = dc
+        self.globals = None  # {name: type name} from the device, or None when it has to be asked again
+        self.members = collections.OrderedDict()  # object: (time, {name: type name}, is a module), by last use
+        self.queries = 0
+
+    def mark_stale(self):
+        # after a cell, which could have changed anything but the modules
+        self.globals = None
+        for n in [n for n, (t, names, module) in self.members.items() if not module]:
+            del self.members[n]
+
+    def device_available(self):
+        # not if it would hold up the completion, or mix the listing into output still coming in
+        return bool(self.dc.serial_exists()) and self.dc.working_reader is not None and \
+            not self.dc.device_bytes_waiting()
+
+    def query(self, n, m):
+        if deviceSymbolLister not in self.dc.helpers_installed:
+            self.members.clear()  # (reconnected or rebooted since)
+            m = m and []
+        self.queries += 1
+        self.dc.install_helpers(deviceSymbolLister)
+        lines = self.dc.execute_statements(["O_syms({}, {})\r\n".format(repr(n), repr(m)).encode()],
+                                           fetch_file_capture_chunks=-1)
+        res = collections.defaultdict(dict)
+        for line in (lines if type(lines) == list else []):
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 3:
+                res[fields[0]][fields[1]] = fields[2]
+        return res
+
+    def refresh(self):
+        if self.globals is None and self.device_available():
+            known = [n for n, (t, names, module) in self.members.items()
+                     if module and time.time() - t < symbolIndexTTL]
+            res = self.query("", known)
+            self.globals = res.pop("", {})
+            for n, names in res.items():
+                self.remember(n, names, True)
+
+    def remember(self, n, names, module):
+        self.members[n] = (time.time(), names, module)
+        self.members.move_to_end(n)
+        while len(self.members) > symbolIndexMaxObjects:
+            self.members.popitem(last=False)
+
+    def global_names(self):
+        self.refresh()
+        names = dict.fromkeys(staticBuiltins, "builtin")
+        names.update(dict.fromkeys(keyword.kwlist, "keyword"))
+        if self.globals is not None:
+            names.update(self.globals)
+        else:
+            names.update(dict.fromkeys(staticModules, "module"))  # (guessing at what could be imported)
+        return names
+
+    def member_names(self, n):
+        self.refresh()
+        entry = self.members.get(n)
+        if entry is not None and time.time() - entry[0] < symbolIndexTTL:
+            self.members.move_to_end(n)
+            return entry[1]
+        obj, dot, name = n.rpartition(".")
+        known = self.member_names(obj) if dot else (self.globals or {})
+        if known.get(name, "property") != "property" and self.globals is not None and self.device_available():
+            names = self.query(n, None).get(n, {})
+            self.remember(n, names, False)
+            return names
+        return dict.fromkeys(staticModules.get(n, []), "")
+
+    def complete(self, code, cursor_pos):
+        line = code[:cursor_pos].rpartition("\n")[2]
+        token = completionToken.search(line).group(1) or ""
+        obj, dot, prefix = token.rpartition(".")
+        if importLine.match(line) and not dot:
+            names = dict.fromkeys(staticModules, "module")
+        elif dot:
+            names = self.member_names(obj)
+        else:
+            names = self.global_names()
+        matches = sorted(name for name in names if name.startswith(prefix))
+        cursor_start = cursor_pos - len(prefix)
+        types = [{"text": name, "type": names[name], "start": cursor_start, "end": cursor_pos} for name in matches]
+        return {"matches": matches, "cursor_start": cursor_start, "cursor_end": cursor_pos,
+                "metadata": {"_jupyter_types_experimental": types}, "status": "ok"}
+
+    def inspect(self, code, cursor_pos):
+        # the type of the dotted name under the cursor, and what is in it
+        m = re.search(r"[A-Za-z_][\w.]*$", code[:cursor_pos])
+        n = (m.group() if m else "") + re.match(r"\w*", code[cursor_pos:]).group()
+        n = n.rstrip(".")
+        if not n or not objectExpression.match(n):
+            return {"status": "ok", "found": False, "data": {}, "metadata": {}}
+        obj, dot, name = n.rpartition(".")
+        typename = (self.member_names(obj) if dot else self.global_names()).get(name)
+        if typename is None:
+            return {"status": "ok", "found": False, "data": {}, "metadata": {}}
+        text = "{}: {}".format(n, typename or "?")
+        members = sorted(self.member_names(n)) if typename in ("module", "type", "") else []
+        if members:
+            text += "\n\n" + ", ".join(members)
+        return {"status": "ok", "found": True, "data": {"text/plain": text}, "metadata": {}}
@@ -0,0 +1,108 @@
+import collections
+import json
+import os
+import time
+
+# opt-in record of the traffic with the device, turned on by %profile.  Times are time.monotonic()
+traceMaxCells = 200
+
+
+# one cell: what was sent and received, with the moments the program was all sent (exec),
+# and the device accepted it (OK, or the ack of a raw paste)
+class CellTrace:
+    def __init__(self, label):
+        self.label = label
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.exec_time = None
+        self.ok_time = None
+        self.first_byte_time = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.events = []  # (time, kind, number of bytes, token)
+
+    def summary(self):
+        def since(t0, t1):
+            return (t1 - t0) if (t0 is not None and t1 is not None) else None
+        return {"cell": self.label,
+                "send": since(self.start_time, self.exec_time),
+                "first_byte": since(self.exec_time, self.first_byte_time),
+                "ok": since(self.exec_time, self.ok_time),
+                "end_to_end": since(self.start_time, self.end_time),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received}
+
+
+class IOTrace:
+    def __init__(self):
+        self.cells = collections.deque(maxlen=traceMaxCells)
+        self.current = None
+
+    def start_cell(self, label):
+        self.end_cell()
+        self.current = CellTrace(label)
+
+    def end_cell(self):
+        if self.current is not None:
+            self.current.end_time = time.monotonic()
+            self.cells.append(self.current)
+            self.current = None
+
+    def sent(self, nbytes):
+        if self.current is not None:
+            self.current.events.append((time.monotonic(), "send", nbytes, None))
+            self.current.bytes_sent += nbytes
+
+    def executing(self):
+        # the whole program is with the device
+        if self.current is not None and self.current.exec_time is None:
+            self.current.exec_time = time.monotonic()
+            self.current.events.append((self.current.exec_time, "exec", 0, None))
+
+    def okay(self):
+        if self.current is not None and self.current.exec_time is not None and self.current.ok_time is None:
+            self.current.ok_time = time.monotonic()
+            self.current.events.append((self.current.ok_time, "ok", 0, None))
+            if self.current.first_byte_time is None:
+                self.current.first_byte_time = self.current.ok_time
+
+    def received(self, token):
+        if self.current is not None:
+            t = time.monotonic()
+            self.current.events.append((t, "recv", len(token), token))
+            self.current.bytes_received += len(token)
+            if self.current.exec_time is not None and self.current.first_byte_time is None:
+                self.current.first_byte_time = t
+
+    def summary_table(self):
+        def ms(t):
+            return "{:9.1f}".format(t * 1000) if t is not None else "{:>9}".format("-")
+        lines = ["{:32}{:>9}{:>9}{:>9}{:>9}{:>9}{:>9}".format("cell (ms)", "send", "1st byte", "OK", "total",
+                                                              "sent", "received")]
+        for cell in self.cells:
+            s = cell.summary()
+            label = s["cell"].strip().splitlines()[0] if s["cell"].strip() else ""
+            lines.append("{:32}{}{}{}{}{:>9}{:>9}".format(label[:31], ms(s["send"]), ms(s["first_byte"]), ms(s["ok"]),
+                                                          ms(s["end_to_end"]), s["bytes_sent"], s["bytes_received"]))
+        return "\n".join(lines) + "\n"
+
+    def save_json(self, filename):
+        with open(filename, "w") as fout:
+            json.dump([dict(cell.summary(), events=[(t - cell.start_time, kind, n) for t, kind, n, token in cell.events])
+                       for cell in self.cells], fout, indent=1)
+
+    def save_chrome_trace(self, filename):
+        # for chrome://tracing or https://ui.perfetto.dev, one row for the cells and one for the traffic
+        events = []
+        pid = os.getpid()
+        for cell in self.cells:
+            s = cell.summary()
+            events.append({"name": s["cell"].strip()[:60], "ph": "X", "pid": pid, "tid": 1,
+                           "ts": cell.start_time * 1e6, "dur": (cell.end_time - cell.start_time) * 1e6, "args": s})
+            for t, kind, n, token in cell.events:
+                event = {"name": kind, "ph": "i", "s": "t", "pid": pid, "tid": 2, "ts": t * 1e6, "args": {"bytes": n}}
+                if token is not None:
+                    event["args"]["token"] = token[:40].decode("utf8", "replace")
+                events.append(event)
+        with open(filename, "w") as fout:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fout)